@@ -0,0 +1,336 @@
+#! /usr/bin/env python2.7
+
+'''
+Archive the delivered messages to a local, segmented, append-only log and
+replay them from any offset (for consumers which join late or crash).
+
+The log is a directory of segments; <base-offset>.log holds the records
+(offset, length, JSON payload) and <base-offset>.index a sparse index of
+(offset, position) entries, one every INDEX_INTERVAL bytes. A segment is
+closed once it reaches SEGMENT_BYTES. Reads mmap the segments and hand out
+buffers over the payloads, nothing is copied.
+
+One process writes to an archive at a time (it holds a lock on it); any
+number can read it. The messages are stored as they were delivered, in
+plain-text (unencrypted); the directory and the files are only readable by
+their owner.
+
+Replay (JSON lines on stdout): ./archive.py DIRECTORY [-o OFFSET] [-f]
+'''
+
+import os
+import sys
+import mmap
+import json
+import time
+import fcntl
+import struct
+import bisect
+import threading
+from collections import OrderedDict
+from argparse import ArgumentParser
+from logging import NullHandler, getLogger
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+ARCHIVE_PATH = 'vault/archive'
+
+# Segment size; a record is never split across segments.
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+# Bytes of records between two index entries.
+INDEX_INTERVAL = 4096
+
+# Record header (offset, payload length) and index entry (offset, position
+# in the segment).
+RECORD = struct.Struct('>QI')
+ENTRY = struct.Struct('>QQ')
+
+# The writer's lock file (in the archive directory).
+LOCK_NAME = '.lock'
+
+# Indexes kept in memory (the most recently used segments); an index only
+# grows, so a cached one is extended rather than read again.
+INDEX_CACHE = 16
+INDEXES = OrderedDict()
+INDEXES_LOCK = threading.Lock()
+
+
+def private(path, mode='ab'):
+    '''
+    Open a file for appending; created readable by the owner only.
+    '''
+    return os.fdopen(os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                             0o600), mode)
+
+
+class Segment(object):
+    '''
+    A log file and its index, starting at the base offset.
+    '''
+    def __init__(self, directory, base):
+        self.base = base
+        name = os.path.join(directory, '{0:020d}'.format(base))
+        self.path = name + '.log'
+        self.index_path = name + '.index'
+
+    def size(self):
+        '''
+        Bytes in the log file.
+        '''
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def entries(self):
+        '''
+        The index, as a string of packed entries (cached, see INDEXES).
+        '''
+        try:
+            size = os.path.getsize(self.index_path)
+        except OSError:
+            return ''
+        size -= size % ENTRY.size
+        with INDEXES_LOCK:
+            data = INDEXES.pop(self.index_path, '')
+        if len(data) != size:
+            if len(data) > size:
+                # Cut off when the writer reopened the segment.
+                data = ''
+            try:
+                with open(self.index_path, 'rb') as index:
+                    index.seek(len(data))
+                    data += index.read(size - len(data))
+            except IOError:
+                return ''
+        with INDEXES_LOCK:
+            INDEXES[self.index_path] = data
+            while len(INDEXES) > INDEX_CACHE:
+                INDEXES.popitem(last=False)
+        return data
+
+    def lookup(self, offset):
+        '''
+        The position of the last indexed record at or before the offset.
+        '''
+        data = self.entries()
+        position, low, high = 0, 0, len(data) // ENTRY.size
+        while low < high:
+            middle = (low + high) // 2
+            current, at = ENTRY.unpack_from(data, middle * ENTRY.size)
+            if current <= offset:
+                position, low = at, middle + 1
+            else:
+                high = middle
+        return position
+
+    def view(self):
+        '''
+        A read-only mmap of the log file; None if it is empty. It is
+        unmapped once the last buffer over it is gone.
+        '''
+        size = self.size()
+        if not size:
+            return None
+        with open(self.path, 'rb') as log:
+            return mmap.mmap(log.fileno(), size, access=mmap.ACCESS_READ)
+
+    def scan(self, view, position=0):
+        '''
+        Yield (offset, position, length) of the complete records from the
+        position on.
+        '''
+        size = len(view)
+        while position + RECORD.size <= size:
+            offset, length = RECORD.unpack_from(view, position)
+            if position + RECORD.size + length > size:
+                return
+            yield offset, position, length
+            position += RECORD.size + length
+
+    def records(self, offset=0):
+        '''
+        Yield (offset, payload) from the offset on; payloads are buffers
+        over the mmap.
+        '''
+        view = self.view()
+        if view is None:
+            return
+        for current, position, length in self.scan(view,
+                                                   self.lookup(offset)):
+            if current >= offset:
+                yield current, buffer(view, position + RECORD.size, length)
+
+    def tail(self):
+        '''
+        The next offset and the position after the last complete record.
+        '''
+        view = self.view()
+        offset, end = self.base, 0
+        if view is not None:
+            for current, position, length in self.scan(
+                    view, self.lookup(sys.maxint)):
+                offset, end = current + 1, position + RECORD.size + length
+        return offset, end
+
+
+def segments(path=ARCHIVE_PATH):
+    '''
+    The segments in the directory, oldest first.
+    '''
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    return [Segment(path, _) for _ in
+            sorted(int(name[:-4]) for name in names
+                   if name.endswith('.log') and name[:-4].isdigit())]
+
+
+def replay(path=ARCHIVE_PATH, offset=0):
+    '''
+    Yield (offset, payload) for every record from the offset on; payloads
+    are buffers over the (mmapped) segments.
+    '''
+    found = segments(path)
+    start = bisect.bisect_right([_.base for _ in found], offset) - 1
+    for segment in found[max(start, 0):]:
+        for record in segment.records(offset):
+            yield record
+
+
+class Archive(object):
+    '''
+    The writer; appends go to the last segment. A record torn by a crash
+    is cut off when the archive is opened. Raises an IOError if another
+    process writes to the archive.
+    '''
+    def __init__(self, path=ARCHIVE_PATH, segment_bytes=SEGMENT_BYTES,
+                 sync=False):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.sync = sync
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+
+        # Held (for the life of the process) until close.
+        self.writer = private(os.path.join(path, LOCK_NAME))
+        try:
+            fcntl.flock(self.writer.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.writer.close()
+            raise IOError('another process writes to {0}'.format(path))
+
+        found = segments(path)
+        self.open(found[-1] if found else Segment(path, 0))
+
+    def open(self, segment):
+        '''
+        Make the segment the one appended to.
+        '''
+        self.segment = segment
+        self.offset, self.position = segment.tail()
+        if segment.size() > self.position:
+            LOGGER.warning('[archive] cutting off a torn record in %s',
+                           segment.path)
+        entries = segment.entries()
+        kept = [entries[_:_ + ENTRY.size]
+                for _ in range(0, len(entries), ENTRY.size)
+                if ENTRY.unpack_from(entries, _)[1] < self.position]
+        self.indexed = ENTRY.unpack(kept[-1])[1] if kept else None
+
+        self.log = private(segment.path)
+        self.log.truncate(self.position)
+        self.index = private(segment.index_path)
+        self.index.truncate(len(kept) * ENTRY.size)
+
+    def roll(self):
+        '''
+        Close the current segment, start the next one.
+        '''
+        self.log.close()
+        self.index.close()
+        self.open(Segment(self.path, self.offset))
+
+    def append(self, record):
+        '''
+        Append a record (JSON-serializable); returns its offset.
+        '''
+        payload = json.dumps(record, sort_keys=True)
+        with self.lock:
+            if self.position and (self.position + RECORD.size +
+                                  len(payload) > self.segment_bytes):
+                self.roll()
+            offset = self.offset
+            self.log.write(RECORD.pack(offset, len(payload)))
+            self.log.write(payload)
+            self.log.flush()
+            if self.sync:
+                os.fsync(self.log.fileno())
+            if self.indexed is None or \
+                    self.position - self.indexed >= INDEX_INTERVAL:
+                self.index.write(ENTRY.pack(offset, self.position))
+                self.index.flush()
+                self.indexed = self.position
+            self.position += RECORD.size + len(payload)
+            self.offset += 1
+        return offset
+
+    def replay(self, offset=0):
+        '''
+        Records from the offset on (see replay).
+        '''
+        return replay(self.path, offset)
+
+    def close(self):
+        '''
+        Close the files, let another process write.
+        '''
+        with self.lock:
+            self.log.close()
+            self.index.close()
+            self.writer.close()
+
+
+def main():
+    '''
+    Validate arguments, replay the archive to stdout.
+    '''
+    message = 'Replay the archived messages (JSON, one per line).'
+    offset_help = 'offset to start from; defaults to 0 (the oldest)'
+    follow_help = 'keep waiting for new messages'
+    directory_help = 'archive directory; defaults to {0}'.format(ARCHIVE_PATH)
+
+    parser = ArgumentParser(description=message)
+    parser.add_argument('directory', help=directory_help, nargs='?',
+                        default=ARCHIVE_PATH, metavar=('DIRECTORY'))
+    parser.add_argument('-o', '--offset', help=offset_help, default=0,
+                        type=int, metavar=('OFFSET'))
+    parser.add_argument('-f', '--follow', help=follow_help,
+                        action='store_true', default=False)
+
+    args = vars(parser.parse_args())
+
+    offset, out = args['offset'], sys.stdout
+    try:
+        while True:
+            for offset, payload in replay(args['directory'], offset):
+                out.write(payload)
+                out.write('\n')
+                offset += 1
+            if not args['follow']:
+                break
+            out.flush()
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    except IOError:
+        # The reader went away (e.g. | head).
+        return
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,11 @@ import json
 import distutils.spawn
 from subprocess import Popen, PIPE
 
+from metrics import timed
+
+# Latency of each call to the Keybase client.
+KEYBASE = ('bus_auth_seconds', 'Latency of Keybase client calls')
+
 
 def clean(text):
     '''
@@ -19,6 +24,7 @@ def clean(text):
     return escape.sub('', text)
 
 
+@timed(*KEYBASE, function='status')
 def status(debug=False):
     '''
     Check the status of the client.
@@ -49,6 +55,7 @@ def status(debug=False):
                     print 'Unable to parse response from the Keybase Client.'
 
 
+@timed(*KEYBASE, function='lookup')
 def lookup(username, debug=False):
     '''
     Check if a user exists on Keybase.
@@ -76,6 +83,7 @@ def lookup(username, debug=False):
             return True
 
 
+@timed(*KEYBASE, function='encrypt')
 def encrypt(plaintext, recipient, debug=False):
     '''
     Encrypt the plain-text (into keybase-saltpack).
@@ -101,6 +109,7 @@ def encrypt(plaintext, recipient, debug=False):
             return stdout.strip()
 
 
+@timed(*KEYBASE, function='sign')
 def sign(plaintext, debug=False):
     '''
     Sign the plain-text (into keybase-saltpack).
@@ -126,6 +135,7 @@ def sign(plaintext, debug=False):
             return stdout.strip()
 
 
+@timed(*KEYBASE, function='verify')
 def verify(signed_saltpack, debug=False):
     '''
     Verify the signed-text (from keybase-saltpack).
@@ -162,6 +172,7 @@ def verify(signed_saltpack, debug=False):
     return flag, who, text
 
 
+@timed(*KEYBASE, function='decrypt')
 def decrypt(encrypted_saltpack, debug=False):
     '''
     Decrypt the encrypted message (from keybase-saltpack).
@@ -0,0 +1,4 @@
+'''
+Offline benchmarks; the real push, stream, pull and expire code is run
+against local stand-ins for GitHub, Twitter, disque and keybase (see fakes).
+'''
@@ -0,0 +1,528 @@
+#! /usr/bin/env python2.7
+
+'''
+Local stand-ins for the external services (for benchmarks):
+    [*] GistStub:    an HTTP server implementing the gist API used by gist.py.
+    [*] DisqueStub:  an in-process server speaking the subset of the disque
+                     protocol used by pydisque (HELLO, ADDJOB, GETJOB, ...).
+    [*] FakeTwitter: a tweepy.API look-alike; posted statuses are fed to the
+                     registered stream listeners from a background thread.
+    [*] KEYBASE:     a deterministic keybase client (bench/keybase).
+'''
+
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+from datetime import datetime
+from urlparse import parse_qs
+from collections import deque
+from Queue import Queue
+from SocketServer import (ThreadingMixIn, ThreadingTCPServer,
+                          StreamRequestHandler)
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+# Directory with the fake keybase executable; prepend it to $PATH.
+KEYBASE = os.path.dirname(os.path.abspath(__file__))
+
+# Rate-limit headers returned by the stubs, so the limiter never waits.
+BUDGET = 10 ** 9
+
+
+def random_id(length=20):
+    '''
+    A random hex ID.
+    '''
+    return hashlib.sha1(os.urandom(16)).hexdigest()[:length]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    '''
+    Serve every request in its own thread.
+    '''
+    daemon_threads = True
+
+
+class GistHandler(BaseHTTPRequestHandler):
+    '''
+    POST /gists, GET /gists[?since=&page=&per_page=], GET /gists/<id>,
+    DELETE /gists/<id>.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, code, payload=None):
+        '''
+        Send a JSON response with rate-limit headers.
+        '''
+        body = '' if payload is None else json.dumps(payload)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Limit', str(BUDGET))
+        self.send_header('X-RateLimit-Remaining', str(BUDGET))
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def gist_id(self):
+        '''
+        The gist ID from the path; None for anything but /gists/<id>.
+        '''
+        parts = self.path.strip('/').split('/')
+        return parts[1] if len(parts) == 2 and parts[0] == 'gists' else None
+
+    def do_POST(self):
+        '''
+        Create a gist.
+        '''
+        length = int(self.headers.getheader('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length))
+        gist_id = random_id()
+        payload['created_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                              time.gmtime())
+        self.server.gists[gist_id] = payload
+        self.reply(201, {'id': gist_id,
+                         'description': payload.get('description')})
+
+    def do_GET(self):
+        '''
+        Fetch a gist, or list them.
+        '''
+        path, _, query = self.path.partition('?')
+        if path.strip('/') == 'gists':
+            self.listing(parse_qs(query))
+            return
+        gist = self.server.gists.get(self.gist_id())
+        if gist is None:
+            self.reply(404, {'message': 'Not Found'})
+        else:
+            self.reply(200, {'id': self.gist_id(), 'files': gist['files'],
+                             'description': gist.get('description')})
+
+    def listing(self, query):
+        '''
+        A page of gists, most recent first (gists are never updated).
+        '''
+        since = query.get('since', [''])[0]
+        size = int(query.get('per_page', [30])[0])
+        page = int(query.get('page', [1])[0])
+        gists = sorted(((gist_id, _) for gist_id, _ in
+                        self.server.gists.items()
+                        if _['created_at'] >= since),
+                       key=lambda _: _[1]['created_at'], reverse=True)
+        self.reply(200, [{'id': gist_id, 'description': _.get('description'),
+                          'created_at': _['created_at'],
+                          'updated_at': _['created_at']}
+                         for gist_id, _ in
+                         gists[(page - 1) * size:page * size]])
+
+    def do_DELETE(self):
+        '''
+        Delete a gist.
+        '''
+        if self.server.gists.pop(self.gist_id(), None) is None:
+            self.reply(404, {'message': 'Not Found'})
+        else:
+            self.reply(204)
+
+    def log_message(self, *_):
+        '''
+        Stay quiet.
+        '''
+        return
+
+
+class GistStub(object):
+    '''
+    Run the gist API stub on a local (ephemeral) port.
+    '''
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), GistHandler)
+        self.server.gists = {}
+        self.url = 'http://{0}:{1}'.format(*self.server.server_address)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='gist-stub')
+        self.thread.daemon = True
+
+    def start(self):
+        '''
+        Start serving.
+        '''
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop serving.
+        '''
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RESPError(Exception):
+    '''
+    Sent back to the client as an error reply.
+    '''
+    pass
+
+
+class DisqueHandler(StreamRequestHandler):
+    '''
+    Parse RESP commands, dispatch them to the stub.
+    '''
+    def read_command(self):
+        '''
+        Read a command (an array of bulk strings).
+        '''
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith('*'):
+            return line.split()
+        command = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def encode(self, value):
+        '''
+        Encode a reply.
+        '''
+        if value is None:
+            return '*-1\r\n'
+        if isinstance(value, bool):
+            return ':{0}\r\n'.format(int(value))
+        if isinstance(value, (int, long)):
+            return ':{0}\r\n'.format(value)
+        if isinstance(value, (list, tuple)):
+            return '*{0}\r\n{1}'.format(len(value), ''.join(
+                self.encode(_) for _ in value))
+        value = str(value)
+        return '${0}\r\n{1}\r\n'.format(len(value), value)
+
+    def handle(self):
+        '''
+        Serve commands until the client goes away.
+        '''
+        while True:
+            try:
+                command = self.read_command()
+            except (socket.error, ValueError):
+                return
+            if not command:
+                return
+            try:
+                reply = self.encode(self.server.stub.execute(command))
+            except RESPError as error:
+                reply = '-ERR {0}\r\n'.format(error)
+            try:
+                self.wfile.write(reply)
+                self.wfile.flush()
+            except socket.error:
+                return
+
+
+class DisqueStub(object):
+    '''
+    A single-node, in-memory disque: jobs are queued FIFO, GETJOB blocks
+    (with an optional timeout), ACKJOB/DELJOB forget the job.
+    '''
+    def __init__(self, host='127.0.0.1', port=0):
+        ThreadingTCPServer.allow_reuse_address = True
+        self.server = ThreadingTCPServer((host, port), DisqueHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.node_id = random_id(40)
+        self.address = '{0}:{1}'.format(*self.server.server_address)
+        self.queues = {}
+        self.jobs = {}
+        self.ready = threading.Condition()
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='disque-stub')
+        self.thread.daemon = True
+
+    def start(self):
+        '''
+        Start serving.
+        '''
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stop serving.
+        '''
+        self.server.shutdown()
+        self.server.server_close()
+
+    def execute(self, command):
+        '''
+        Run a command; returns the reply value.
+        '''
+        name, args = command[0].upper(), command[1:]
+        handler = getattr(self, 'cmd_' + name.lower(), None)
+        if handler is None:
+            raise RESPError('unknown command \'{0}\''.format(name))
+        return handler(args)
+
+    def cmd_ping(self, _):
+        '''
+        PING
+        '''
+        return 'PONG'
+
+    def cmd_hello(self, _):
+        '''
+        HELLO; a single node.
+        '''
+        host, port = self.address.split(':')
+        return [1, self.node_id, [self.node_id, host, port, '1']]
+
+    def cmd_info(self, _):
+        '''
+        INFO
+        '''
+        with self.ready:
+            queued = sum(len(_) for _ in self.queues.values())
+            return ('# Server\r\ndisque_version:stub\r\n'
+                    '# Jobs\r\nregistered_jobs:{0}\r\n'
+                    '# Queues\r\nregistered_queues:{1}\r\n'
+                    'queued_jobs:{2}\r\n').format(len(self.jobs),
+                                                  len(self.queues), queued)
+
+    def cmd_addjob(self, args):
+        '''
+        ADDJOB queue body ms-timeout [options]; options are ignored.
+        '''
+        if len(args) < 3:
+            raise RESPError('wrong number of arguments for \'ADDJOB\'')
+        queue, body = args[0], args[1]
+        job_id = 'D-{0}-{1}'.format(self.node_id[:8], random_id(24))
+        with self.ready:
+            self.jobs[job_id] = (queue, body)
+            self.queues.setdefault(queue, deque()).append(job_id)
+            self.ready.notify_all()
+        return job_id
+
+    def cmd_getjob(self, args):
+        '''
+        GETJOB [NOHANG] [TIMEOUT ms] [COUNT n] [WITHCOUNTERS] FROM q1 ...
+        '''
+        nohang, timeout, count, counters = False, 0, 1, False
+        args = list(args)
+        while args:
+            option = args.pop(0).upper()
+            if option == 'NOHANG':
+                nohang = True
+            elif option == 'TIMEOUT':
+                timeout = int(args.pop(0))
+            elif option == 'COUNT':
+                count = int(args.pop(0))
+            elif option == 'WITHCOUNTERS':
+                counters = True
+            elif option == 'FROM':
+                break
+        queues = args
+        if not queues:
+            raise RESPError('syntax error')
+
+        deadline = time.time() + timeout / 1000.0 if timeout else None
+        with self.ready:
+            while True:
+                jobs = []
+                for queue in queues:
+                    pending = self.queues.get(queue)
+                    while pending and len(jobs) < count:
+                        job_id = pending.popleft()
+                        if job_id in self.jobs:
+                            jobs.append(job_id)
+                if jobs or nohang:
+                    break
+                wait = None if deadline is None else deadline - time.time()
+                if wait is not None and wait <= 0:
+                    break
+                self.ready.wait(wait if wait is not None else 1.0)
+
+            if not jobs:
+                return None
+            replies = []
+            for job_id in jobs:
+                queue, body = self.jobs[job_id]
+                reply = [queue, job_id, body]
+                if counters:
+                    reply += ['nacks', 0, 'additional-deliveries', 0]
+                replies.append(reply)
+            return replies
+
+    def forget(self, job_ids):
+        '''
+        Drop jobs (and dequeue them if still queued).
+        '''
+        removed = 0
+        with self.ready:
+            for job_id in job_ids:
+                job = self.jobs.pop(job_id, None)
+                if job is None:
+                    continue
+                removed += 1
+                try:
+                    self.queues[job[0]].remove(job_id)
+                except ValueError:
+                    pass
+        return removed
+
+    def cmd_ackjob(self, args):
+        '''
+        ACKJOB id ...
+        '''
+        return self.forget(args)
+
+    def cmd_fastack(self, args):
+        '''
+        FASTACK id ...
+        '''
+        return self.forget(args)
+
+    def cmd_deljob(self, args):
+        '''
+        DELJOB id ...
+        '''
+        return self.forget(args)
+
+    def cmd_nack(self, args):
+        '''
+        NACK id ...; put the jobs back in their queues.
+        '''
+        with self.ready:
+            for job_id in args:
+                if job_id in self.jobs:
+                    queue = self.jobs[job_id][0]
+                    self.queues.setdefault(queue, deque()).append(job_id)
+            self.ready.notify_all()
+        return len(args)
+
+    def cmd_qlen(self, args):
+        '''
+        QLEN queue
+        '''
+        with self.ready:
+            return len(self.queues.get(args[0], ()))
+
+
+class Author(object):
+    '''
+    The author of a status.
+    '''
+    def __init__(self, screen_name):
+        self.screen_name = screen_name
+
+
+class Status(object):
+    '''
+    A tweepy.Status look-alike.
+    '''
+    def __init__(self, status_id, text, screen_name):
+        self.id = status_id
+        self.id_str = str(status_id)
+        self.text = text
+        self.author = Author(screen_name)
+        self.user = self.author
+        self.timestamp_ms = str(int(time.time() * 1000))
+        self.created_at = datetime.utcnow()
+
+    def __repr__(self):
+        return 'Status(id={0}, text={1!r})'.format(self.id, self.text)
+
+
+class Response(object):
+    '''
+    Carries the rate-limit headers (see ratelimit.twitter).
+    '''
+    headers = {
+        'x-rate-limit-limit': str(BUDGET),
+        'x-rate-limit-remaining': str(BUDGET),
+        'x-rate-limit-reset': str(int(time.time()) + 3600),
+    }
+
+
+class OAuth(object):
+    '''
+    The auth attribute of the API.
+    '''
+    def __init__(self, access_token):
+        self.access_token = access_token
+
+
+class FakeTwitter(object):
+    '''
+    The subset of tweepy.API used by the bus, plus a feeder delivering every
+    posted status to the registered stream listeners.
+    '''
+    def __init__(self, screen_name='bench', latency=0.0):
+        self.screen_name = screen_name
+        self.latency = latency
+        self.auth = OAuth(random_id())
+        self.last_response = Response()
+        self.timeline = []
+        self.listeners = []
+        self.feed = Queue()
+        self.lock = threading.Lock()
+        self.counter = 1000
+        self.thread = threading.Thread(target=self.deliver, name='feeder')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def listen(self, listener):
+        '''
+        Register a tweepy.StreamListener.
+        '''
+        self.listeners.append(listener)
+
+    def deliver(self):
+        '''
+        Hand statuses to the listeners, in order.
+        '''
+        while True:
+            status = self.feed.get()
+            for listener in self.listeners:
+                listener.on_status(status)
+
+    def update_status(self, status, *_, **__):
+        '''
+        Post a status; it shows up on the stream.
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.counter += 1
+            tweet = Status(self.counter, status, self.screen_name)
+            self.timeline.append(tweet)
+        self.feed.put(tweet)
+        return tweet
+
+    def destroy_status(self, status_id, *_, **__):
+        '''
+        Delete a status.
+        '''
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            for tweet in self.timeline:
+                if tweet.id_str == str(status_id):
+                    self.timeline.remove(tweet)
+                    return tweet
+        return None
+
+    def user_timeline(self, screen_name=None, since_id=None, max_id=None,
+                      count=20, *_, **__):
+        '''
+        The most recent statuses first; since_id/max_id bound the page.
+        '''
+        with self.lock:
+            tweets = [_ for _ in reversed(self.timeline)
+                      if (since_id is None or _.id > int(since_id)) and
+                      (max_id is None or _.id <= int(max_id))]
+        return tweets[:count]
@@ -0,0 +1,264 @@
+#! /usr/bin/env python2.7
+
+'''
+Push messages through the real push, stream, pull and expire code, backed
+by the local fakes; report the throughput and the latency per stage for
+each message size.
+
+Run from the source directory: python -m bench.run [OPTIONS]
+'''
+
+import os
+import sys
+import time
+import tempfile
+import threading
+from Queue import Queue, Empty
+from argparse import ArgumentParser
+from logging import getLogger, shutdown, DEBUG, WARNING
+
+import gist
+import node
+import push
+import pull
+import stream
+import expire
+from log import setup
+from cluster import Cluster
+from routing import Router, queues_of, NORMAL
+from tracing import TRACER, report
+from bench.fakes import GistStub, DisqueStub, FakeTwitter, KEYBASE
+
+# Keybase-ID of the (fake) recipient.
+RECIPIENT = 'bench'
+
+
+def connect(address):
+    '''
+    A new disque client (one per daemon, as if they ran as processes).
+    '''
+    queue = Cluster([address])
+    queue.connect()
+    return queue
+
+
+def spawn(target, *args):
+    '''
+    Run the target in a daemon thread.
+    '''
+    thread = threading.Thread(target=target, args=args,
+                              name=getattr(target, '__name__', None))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def wait_for(counter, value, timeout):
+    '''
+    Wait until the counter reaches the value; False on timeout.
+    '''
+    deadline = time.time() + timeout
+    while counter() < value:
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def settled():
+    '''
+    Messages delivered or dropped by pull so far.
+    '''
+    return pull.DELIVERED.value + sum(_.value for _ in pull.FAILURES.values())
+
+
+def removed():
+    '''
+    Gists and tweets deleted by expire so far.
+    '''
+    return sum(_.count for _ in expire.REMOVE_LATENCY.values())
+
+
+class Bench(object):
+    '''
+    The fakes, a stream listener, pull workers and expire workers; as
+    separate daemons or combined (like node.py); routed messages go
+    through the recipient's queue.
+    '''
+    def __init__(self, workers=1, expirers=1, latency=0.0, combined=False,
+                 routed=False):
+        os.environ['PATH'] = os.pathsep.join([KEYBASE, os.environ['PATH']])
+
+        self.gists = GistStub().start()
+        gist.GITHUB_API_URL = self.gists.url
+        self.disque = DisqueStub().start()
+        self.twitter = FakeTwitter(screen_name=RECIPIENT, latency=latency)
+        self.auth = ('bench-token', self.twitter)
+
+        self.routed = routed
+        recipients = [RECIPIENT] if routed else None
+        # Tagged announcements go to the recipient's queue.
+        router = Router(['*:{0}={0}'.format(RECIPIENT)] if routed else [])
+
+        address = self.disque.address
+        if combined:
+            # One process-wide client and the in-process handoff (node.py).
+            queue = connect(address)
+            handoff = node.start(queue, self.auth, workers=workers,
+                                 expirers=expirers, retry=0,
+                                 recipients=recipients)
+            if handoff is None:
+                raise RuntimeError('keybase is not available (see '
+                                   'bench/keybase)')
+            self.twitter.listen(stream.StreamDaemon(queue,
+                                                    handoff=handoff.offer,
+                                                    router=router))
+            return
+        self.twitter.listen(stream.StreamDaemon(connect(address),
+                                                router=router))
+        for _ in range(workers):
+            spawn(pull.receive, self.auth[0], connect(address), 0, False,
+                  queues_of(recipients))
+        for _ in range(expirers):
+            spawn(expire.listen, connect(address), self.auth, False, 0)
+
+    def run(self, count, size, pushers=1, ttl=0, timeout=120, urgent=0.0):
+        '''
+        Push count messages of the given size (the urgent share of them in
+        the high lane); returns the summary and the file with the trace
+        spans.
+        '''
+        spans = tempfile.NamedTemporaryFile(prefix='bench-', suffix='.jsonl',
+                                            delete=False)
+        spans.close()
+        TRACER.open(spans.name, service='bench')
+
+        plaintext = ('0123456789abcdef' * (size // 16 + 1))[:size]
+        delivered, before, deleted = (pull.DELIVERED.value, settled(),
+                                      removed())
+        lanes = dict((lane, (_.count, _.sum))
+                     for lane, _ in pull.LATENCY.items())
+        pending = Queue()
+        every = int(round(1 / urgent)) if urgent else 0
+        for index in range(count):
+            pending.put('high' if every and index % every == 0 else NORMAL)
+
+        def pusher():
+            '''
+            Send messages until none are left.
+            '''
+            queue = connect(self.disque.address) if ttl else None
+            while True:
+                try:
+                    lane = pending.get_nowait()
+                except Empty:
+                    return
+                push.send(plaintext=plaintext, auth=self.auth,
+                          recipient=RECIPIENT, ttl=ttl, queue=queue,
+                          tag=self.routed, priority=lane)
+
+        start = time.time()
+        for thread in [spawn(pusher) for _ in range(pushers)]:
+            thread.join()
+        sent = time.time()
+        received = wait_for(settled, before + count, timeout)
+        done = time.time()
+        expired = None
+        if ttl:
+            expired = wait_for(removed, deleted + 2 * count, ttl + timeout)
+
+        delivered = pull.DELIVERED.value - delivered
+        for lane, (counted, total) in lanes.items():
+            counted = pull.LATENCY[lane].count - counted
+            total = pull.LATENCY[lane].sum - total
+            lanes[lane] = (counted, total / counted if counted else 0.0)
+        return {
+            'size': size,
+            'messages': count,
+            'delivered': delivered,
+            'dropped': settled() - before - delivered,
+            'complete': received,
+            'expired': expired,
+            'push-rate': count / max(sent - start, 1e-9),
+            'end-to-end-rate': count / max(done - start, 1e-9),
+            'seconds': done - start,
+            'lanes': lanes,
+        }, spans.name
+
+
+def summarize(result, out=sys.stdout):
+    '''
+    Print the summary of a run.
+    '''
+    out.write('\nsize: {size} bytes; messages: {messages}; '
+              'delivered: {delivered}; dropped: {dropped} ({0})\n'.format(
+                  'complete' if result['complete'] else 'timed out',
+                  **result))
+    out.write('push: {push-rate:.1f} msg/s; end-to-end: '
+              '{end-to-end-rate:.1f} msg/s; elapsed: {seconds:.2f}s\n'.format(
+                  **result))
+    if result['expired'] is not None:
+        out.write('expiry: {0}\n'.format('complete' if result['expired']
+                                         else 'timed out'))
+    out.write('lanes: {0}\n'.format('; '.join(
+        '{0}: {1} msgs, mean {2:.1f} ms'.format(lane, counted, mean * 1000)
+        for lane, (counted, mean) in sorted(result['lanes'].items())
+        if counted)))
+
+
+def main():
+    '''
+    Validate arguments, run the benchmark for every message size.
+    '''
+    message = 'Benchmark the message bus against local fakes.'
+    parser = ArgumentParser(description=message)
+    parser.add_argument('-n', '--messages', help='messages per size',
+                        default=100, type=int, metavar=('N'))
+    parser.add_argument('-z', '--sizes', help='message sizes (in bytes)',
+                        default=[64, 1024, 16384], type=int, nargs='+',
+                        metavar=('SIZE'))
+    parser.add_argument('-c', '--concurrency', help='concurrent pushers',
+                        default=1, type=int, metavar=('N'))
+    parser.add_argument('-w', '--workers', help='pull workers',
+                        default=1, type=int, metavar=('N'))
+    parser.add_argument('-x', '--expirers', help='expire workers',
+                        default=1, type=int, metavar=('N'))
+    parser.add_argument('-t', '--ttl', help='TTL of the messages (seconds)',
+                        default=0, type=int, metavar=('N'))
+    parser.add_argument('-l', '--latency', help='added Twitter API latency',
+                        default=0.0, type=float, metavar=('SECONDS'))
+    parser.add_argument('-N', '--node', help='run the daemons as one node',
+                        action='store_true', default=False)
+    parser.add_argument('-g', '--tag', help='route by recipient tags',
+                        action='store_true', default=False)
+    parser.add_argument('-u', '--urgent', help='share of high priority '
+                        'messages', default=0.0, type=float,
+                        metavar=('FRACTION'))
+    parser.add_argument('-d', '--debug', help='enable debugging',
+                        action='store_true', default=False)
+
+    args = vars(parser.parse_args())
+
+    setup(debug=args['debug'])
+    getLogger().setLevel(DEBUG if args['debug'] else WARNING)
+
+    bench = Bench(workers=args['workers'], expirers=args['expirers'],
+                  latency=args['latency'], combined=args['node'],
+                  routed=args['tag'])
+    for size in args['sizes']:
+        result, spans = bench.run(args['messages'], size,
+                                  pushers=args['concurrency'],
+                                  ttl=args['ttl'], urgent=args['urgent'])
+        summarize(result)
+        report([spans])
+        os.remove(spans)
+
+    # The workers are blocked on the queue in daemon threads; skip the
+    # (noisy) interpreter teardown.
+    sys.stdout.flush()
+    shutdown()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#! /usr/bin/env python2.7
+
+'''
+Measure the start-up (import) time of the entry points, in fresh
+interpreters; a per-module breakdown (self and cumulative time, like
+python3's -X importtime) shows what dominates.
+
+Run from the source directory: python -m bench.startup [OPTIONS]
+'''
+
+import os
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+
+# Entry points to measure.
+MODULES = ('push', 'pull', 'stream', 'expire')
+
+# Runs in the child interpreter; times every import through __import__.
+PROBE = r'''
+import sys, time, json, __builtin__
+original, stack, timings = __builtin__.__import__, [], dict()
+
+def timed(name, *args, **kwargs):
+    known = name in sys.modules
+    start = time.time()
+    stack.append(0.0)
+    try:
+        return original(name, *args, **kwargs)
+    finally:
+        children = stack.pop()
+        elapsed = time.time() - start
+        if stack:
+            stack[-1] += elapsed
+        if not known and name in sys.modules:
+            entry = timings.setdefault(name, [0.0, 0.0])
+            entry[0] += elapsed - children
+            entry[1] += elapsed
+
+__builtin__.__import__ = timed
+start = time.time()
+import {module}
+total = time.time() - start
+__builtin__.__import__ = original
+sys.stdout.write(json.dumps(dict(total=total, modules=timings)))
+'''
+
+
+def probe(module, python=sys.executable):
+    '''
+    Import the module in a fresh interpreter; returns the timings.
+    '''
+    child = subprocess.Popen([python, '-c', PROBE.format(module=module)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             cwd=os.getcwd(), close_fds=True)
+    stdout, stderr = child.communicate()
+    if child.returncode != 0:
+        raise RuntimeError('unable to import {0}:\n{1}'.format(
+            module, stderr.strip()))
+    return json.loads(stdout)
+
+
+def median(values):
+    '''
+    The median of a list.
+    '''
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(module, runs=5, top=10, out=sys.stdout):
+    '''
+    Print the median import time of a module and its slowest imports.
+    '''
+    results = [probe(module) for _ in range(runs)]
+    out.write('\n{0}: {1:.1f} ms (median of {2})\n'.format(
+        module, median([_['total'] for _ in results]) * 1000, runs))
+
+    selves, totals = {}, {}
+    for result in results:
+        for name, (own, cumulative) in result['modules'].items():
+            selves.setdefault(name, []).append(own)
+            totals.setdefault(name, []).append(cumulative)
+
+    slowest = sorted(totals, key=lambda _: median(totals[_]), reverse=True)
+    out.write('{0:>12}{1:>12}  {2}\n'.format('self (ms)', 'cumul (ms)',
+                                             'module'))
+    for name in slowest[:top]:
+        out.write('{0:>12.1f}{1:>12.1f}  {2}\n'.format(
+            median(selves[name]) * 1000, median(totals[name]) * 1000, name))
+
+
+def main():
+    '''
+    Validate arguments, measure every entry point.
+    '''
+    message = 'Measure the import time of the entry points.'
+    parser = ArgumentParser(description=message)
+    parser.add_argument('modules', help='modules to import; defaults to all',
+                        default=list(MODULES), nargs='*', metavar=('MODULE'))
+    parser.add_argument('-n', '--runs', help='runs per module', default=5,
+                        type=int, metavar=('N'))
+    parser.add_argument('-k', '--top', help='slowest imports to show',
+                        default=10, type=int, metavar=('N'))
+
+    args = vars(parser.parse_args())
+
+    for module in args['modules']:
+        measure(module, runs=args['runs'], top=args['top'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,323 @@
+#! /usr/bin/env python2.7
+
+'''
+A cluster-aware disque client, on top of pydisque's. It knows all the
+nodes: the given ones and the ones HELLO lists. It tracks their health
+and latency, and sends commands to the node which produced the most jobs
+lately; this is the affinity disque recommends for consumers. A node that
+fails is marked down and tried again after a jittered, exponential
+back-off. Meanwhile, commands fail over to the next node. Each node has a
+blocking pool of connections, so all the threads of a process share one
+client.
+
+A command only fails over if the node never got it, or if running it again
+is harmless (see IDEMPOTENT); a write (ADDJOB, ACKJOB, ...) which the node
+may have run is not sent again, the error is raised instead.
+'''
+
+import time
+import random
+import threading
+from logging import NullHandler, getLogger
+
+import redis
+from redis.exceptions import ConnectionError, TimeoutError
+from pydisque.client import Client, Node
+
+from metrics import REGISTRY
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Connections per node and how long a thread waits for one (in seconds);
+# socket timeouts (the read timeout must exceed the GETJOB timeout, see
+# polling).
+POOL_SIZE, POOL_WAIT = 16, 5
+CONNECT_TIMEOUT, SOCKET_TIMEOUT = 2, 10
+
+# Back-off for a node which is down (in seconds): first, longest.
+BACKOFF = (0.5, 30)
+
+# Pick the node again after this many jobs, or this many seconds.
+REBALANCE_JOBS, REBALANCE_INTERVAL = 100, 30
+
+# How long a command waits for a node to come back (in seconds).
+PATIENCE = 60
+
+# Commands which may run again, on another node, after the connection
+# dropped while waiting for the reply: they only read, or (GETJOB) what
+# they took is delivered again after its retry time.
+IDEMPOTENT = frozenset(['GETJOB', 'HELLO', 'INFO', 'PING', 'QLEN', 'QPEEK',
+                        'QSCAN', 'JSCAN', 'SHOW'])
+
+# Weight of a new sample in the (smoothed) latency.
+SMOOTHING = 0.2
+
+# Metrics.
+FAILOVERS = REGISTRY.counter('bus_disque_failovers_total',
+                             'Commands moved to another disque node')
+
+
+def prefix_of(job_id):
+    '''
+    The node ID prefix in a job ID (D-<prefix>-... or DI<prefix>...).
+    '''
+    if job_id[:2] in ('D-', 'DI'):
+        return job_id[2:10]
+    return None
+
+
+class Health(object):
+    '''
+    What is known about a node: whether it is up, its latency, the jobs
+    it produced (since the last pick) and when to try it again.
+    '''
+    def __init__(self, address):
+        self.address = address
+        self.connection = None
+        self.node = None
+        self.up = False
+        self.latency = None
+        self.jobs = 0
+        self.failures = 0
+        self.retry_at = 0.0
+        self.gauges = (REGISTRY.gauge('bus_disque_node_up',
+                                      'Whether a disque node answers',
+                                      node=address),
+                       REGISTRY.gauge('bus_disque_node_latency_seconds',
+                                      'Smoothed command latency',
+                                      node=address))
+        self.counter = REGISTRY.counter('bus_disque_node_jobs_total',
+                                        'Jobs received, by the node which '
+                                        'produced them', node=address)
+
+    def observe(self, seconds):
+        '''
+        Fold a command's latency into the average.
+        '''
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += SMOOTHING * (seconds - self.latency)
+        self.gauges[1].set(self.latency)
+
+    def produced(self, count):
+        '''
+        Count the jobs received from the node.
+        '''
+        self.jobs += count
+        self.counter.inc(count)
+
+    def recovered(self):
+        '''
+        The node answers.
+        '''
+        self.up, self.failures = True, 0
+        self.gauges[0].set(1)
+
+    def failed(self):
+        '''
+        The node is down; it is tried again after a jittered back-off.
+        '''
+        self.up = False
+        self.failures += 1
+        delay = min(BACKOFF[0] * 2 ** (self.failures - 1), BACKOFF[1])
+        self.retry_at = time.time() + random.uniform(delay / 2, delay)
+        self.gauges[0].set(0)
+
+
+class Cluster(Client):
+    '''
+    A pydisque client which spreads over the nodes of a cluster; one
+    instance is shared by all the threads of a process.
+    '''
+    def __init__(self, nodes=None, **kwargs):
+        Client.__init__(self, nodes)
+        self.pool_size = kwargs['pool_size'] if 'pool_size' in kwargs \
+            else POOL_SIZE
+        self.patience = kwargs['patience'] if 'patience' in kwargs \
+            else PATIENCE
+        self.health = dict((_, Health(_)) for _ in self.nodes)
+        self.chosen = None
+        self.received = 0
+        self.picked_at = self.decayed_at = 0.0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        '''
+        Say HELLO to every node; raises a ConnectionError if none answers.
+        '''
+        for health in list(self.health.values()):
+            self.hello(health)
+        with self.lock:
+            self.pick(time.time())
+        if self.chosen is None:
+            raise ConnectionError('unable to connect to any disque node: '
+                                  '{0}'.format(', '.join(self.health)))
+        LOGGER.info('[disque] connected to %s', self.chosen.address)
+
+    def hello(self, health):
+        '''
+        (Re)connect to a node and learn the others; True if it answers.
+        '''
+        host, port = health.address.rsplit(':', 1)
+        if health.connection is None:
+            pool = redis.BlockingConnectionPool(
+                host=host, port=int(port), max_connections=self.pool_size,
+                timeout=POOL_WAIT, socket_timeout=SOCKET_TIMEOUT,
+                socket_connect_timeout=CONNECT_TIMEOUT)
+            health.connection = redis.Redis(connection_pool=pool)
+        start = time.time()
+        try:
+            reply = health.connection.execute_command('HELLO')
+        except (ConnectionError, TimeoutError) as _error:
+            with self.lock:
+                self.failed(health, _error)
+            return False
+
+        with self.lock:
+            health.node = Node(reply[1], host, int(port), health.connection)
+            self.nodes[health.address] = health.node
+            health.recovered()
+            health.observe(time.time() - start)
+            for other in reply[2:]:
+                address = '{0}:{1}'.format(other[1], other[2])
+                if address not in self.health:
+                    LOGGER.info('[disque] found node %s', address)
+                    self.health[address] = Health(address)
+                    self.nodes[address] = None
+        return True
+
+    def failed(self, health, error):
+        '''
+        Mark a node down (holding the lock).
+        '''
+        if health.up:
+            LOGGER.warning('[disque] node %s is down: %s', health.address,
+                           error)
+        health.failed()
+        if health.connection is not None:
+            health.connection.connection_pool.disconnect()
+        if health is self.chosen:
+            FAILOVERS.inc()
+            self.chosen = None
+
+    def pick(self, now):
+        '''
+        Choose the node (holding the lock): the one which produced the most
+        jobs since the last pick, the fastest one on a tie.
+        '''
+        up = [_ for _ in self.health.values() if _.up]
+        best = max(up, key=lambda _: (_.jobs, -_.latency)) if up else None
+        current = self.chosen
+        if current is None or not current.up or \
+                (best is not None and best.jobs > current.jobs):
+            if best is not current and best is not None:
+                LOGGER.info('[disque] using node %s', best.address)
+            self.chosen = current = best
+        self.connected_node = current.node if current else None
+        # Older counts weigh less (halved every interval), so the choice
+        # follows the traffic.
+        if now - self.decayed_at >= REBALANCE_INTERVAL:
+            for health in self.health.values():
+                health.jobs //= 2
+            self.decayed_at = now
+        self.received, self.picked_at = 0, now
+
+    def current(self):
+        '''
+        The node to send the next command to; None if all are down.
+        '''
+        now = time.time()
+        with self.lock:
+            due = [_ for _ in self.health.values()
+                   if not _.up and _.retry_at <= now]
+            # Only one thread tries a node which is due.
+            for health in due:
+                health.retry_at = now + BACKOFF[1]
+        for health in due:
+            self.hello(health)
+        with self.lock:
+            if self.chosen is None or not self.chosen.up or \
+                    self.received >= REBALANCE_JOBS or \
+                    now - self.picked_at >= REBALANCE_INTERVAL:
+                self.pick(now)
+            return self.chosen
+
+    def count(self, jobs):
+        '''
+        Credit the nodes which produced the jobs (GETJOB replies).
+        '''
+        with self.lock:
+            prefixes = dict((_.node.node_id[:8], _)
+                            for _ in self.health.values()
+                            if _.node is not None)
+            for job in jobs:
+                health = prefixes.get(prefix_of(job[1]))
+                if health is not None:
+                    health.produced(1)
+            self.received += len(jobs)
+
+    def get_connection(self):
+        '''
+        The connection to the current node.
+        '''
+        health = self.current()
+        if health is None:
+            raise ConnectionError('no disque node is reachable')
+        return health.connection
+
+    def send(self, health, *args, **options):
+        '''
+        Run a command on a node. Unlike redis-py, it is never sent twice;
+        an error raised once it was sent is marked (error.sent).
+        '''
+        client = health.connection
+        pool = client.connection_pool
+        connection = pool.get_connection(args[0], **options)
+        sent = False
+        try:
+            connection.send_command(*args)
+            sent = True
+            return client.parse_response(connection, args[0], **options)
+        except (ConnectionError, TimeoutError) as _error:
+            connection.disconnect()
+            _error.sent = sent
+            raise
+        finally:
+            pool.release(connection)
+
+    def execute_command(self, *args, **kwargs):
+        '''
+        Run a command on the current node; fail over to the others, wait
+        (up to patience seconds) for one to come back if all are down.
+        '''
+        deadline = time.time() + self.patience
+        while True:
+            health = self.current()
+            if health is not None:
+                start = time.time()
+                try:
+                    reply = self.send(health, *args, **kwargs)
+                except (ConnectionError, TimeoutError) as _error:
+                    with self.lock:
+                        self.failed(health, _error)
+                    if getattr(_error, 'sent', False) and \
+                            args[0].upper() not in IDEMPOTENT:
+                        # The node may have run it already.
+                        raise
+                    continue
+                if args[0] == 'GETJOB':
+                    # Blocks on the server; only the jobs are counted.
+                    if reply:
+                        self.count(reply)
+                else:
+                    health.observe(time.time() - start)
+                return reply
+
+            now = time.time()
+            if now >= deadline:
+                raise ConnectionError('no disque node is reachable')
+            with self.lock:
+                retry_at = min(_.retry_at for _ in self.health.values())
+            time.sleep(max(min(retry_at, deadline) - now, 0.05))
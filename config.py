@@ -0,0 +1,193 @@
+#! /usr/bin/env python2.7
+
+'''
+Load the credentials from the vault once per process, hand out shared
+(pooled) API clients and swap the credentials when the vault-file changes,
+without restarting the daemons.
+
+Credentials are stored here, change this path to override defaults.
+
+Notes:
+    [*] Get a personal access token on Github: https://git.io/vmNUX;
+        make sure you include 'gist' in the scope.
+    [*] Get a personal access token for your application on Twitter:
+        https://dev.twitter.com/oauth/overview/application-owner-access-tokens;
+        make sure you create an application before you create the access
+        tokens.
+    [*] API error codes: https://dev.twitter.com/overview/api/response-codes
+
+By defualt, keys are stored this way (in JSON):
+    {
+        "github": "github-personal-access-token",
+        "twitter": {
+            "consumer-key": "twitter-app-consumer-key",
+            "consumer-secret": "twitter-app-consumer-secret",
+            "access-token": "twitter-app-access-token",
+            "access-token-secret": "twitter-app-access-token-secret"
+        }
+    }
+'''
+
+import os
+import json
+import time
+import threading
+from logging import NullHandler, getLogger
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+VAULT_PATH = 'vault/keys.json'
+
+# Check the vault-file for changes at most this often (in seconds).
+INTERVAL = 5
+
+# Twitter keys, in the order tweepy wants them.
+TWITTER_KEYS = ('consumer-key', 'consumer-secret', 'access-token',
+                'access-token-secret')
+
+
+class Vault(object):
+    '''
+    The parsed vault-file; reloaded (and swapped atomically) when its mtime
+    changes. A broken vault-file keeps the last good credentials.
+    '''
+    def __init__(self, path=VAULT_PATH, interval=INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.mtime = None
+        self.checked = 0
+        self.state = {'github': None, 'twitter': None}
+        self.refresh(force=True)
+
+    def read(self):
+        '''
+        Parse the vault-file; None if it can't be read or parsed.
+        '''
+        try:
+            with open(self.path, 'r') as vault_file:
+                vault = json.loads(vault_file.read())
+            return {
+                'github': vault['github'],
+                'twitter': tuple(vault['twitter'][_] for _ in TWITTER_KEYS),
+            }
+        except IOError:
+            LOGGER.error('[vault] unable to read vault-file: %s', self.path)
+        except (KeyError, TypeError, ValueError):
+            LOGGER.error('[vault] unable to parse the vault-file: %s',
+                         self.path)
+        return None
+
+    def refresh(self, force=False):
+        '''
+        Reload the vault if the file changed (checked every interval).
+        '''
+        now = time.time()
+        if not force and now - self.checked < self.interval:
+            return
+        with self.lock:
+            if not force and now - self.checked < self.interval:
+                return
+            self.checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime == self.mtime and not force:
+                return
+            state = self.read()
+            if state is not None:
+                # A broken file is read again at the next check.
+                self.mtime = mtime
+                if self.state['github'] is not None:
+                    LOGGER.info('[vault] credentials reloaded')
+                self.clients = dict((keys, api) for keys, api in
+                                    self.clients.items()
+                                    if keys == state['twitter'])
+                self.state = state
+
+    def github(self):
+        '''
+        The (current) GitHub personal access token.
+        '''
+        self.refresh()
+        return self.state['github']
+
+    def twitter(self):
+        '''
+        A tweepy.API for the (current) Twitter keys; shared by all callers.
+        '''
+        self.refresh()
+        with self.lock:
+            keys = self.state['twitter']
+            if keys is None:
+                return None
+            api = self.clients.get(keys)
+            if api is None:
+                import tweepy
+                auth = tweepy.OAuthHandler(keys[0], keys[1])
+                auth.set_access_token(keys[2], keys[3])
+                api = self.clients[keys] = tweepy.API(auth)
+            return api
+
+
+class Credentials(object):
+    '''
+    A live (github-token, tweepy.API) pair; it can be indexed and unpacked
+    like a tuple, every access returns the current credentials.
+    '''
+    def __init__(self, vault):
+        self.vault = vault
+
+    @property
+    def github(self):
+        '''
+        The GitHub token.
+        '''
+        return self.vault.github()
+
+    @property
+    def twitter(self):
+        '''
+        The tweepy.API.
+        '''
+        return self.vault.twitter()
+
+    def __getitem__(self, index):
+        return (self.github, self.twitter)[index]
+
+    def __iter__(self):
+        return iter((self.github, self.twitter))
+
+    def __len__(self):
+        return 2
+
+    def __contains__(self, item):
+        return item in (self.github, self.twitter)
+
+
+# One vault per path, shared by every module in the process.
+VAULTS = {}
+VAULTS_LOCK = threading.Lock()
+
+
+def load_credentials(path=VAULT_PATH):
+    '''
+    Load credentials from vault (once per process).
+    '''
+    with VAULTS_LOCK:
+        if path not in VAULTS:
+            VAULTS[path] = Vault(path)
+    return Credentials(VAULTS[path])
+
+
+def github_token(token):
+    '''
+    The current GitHub token of credentials, of a (token, API) pair or a
+    plain token.
+    '''
+    if isinstance(token, Credentials):
+        return token.github
+    return token[0] if isinstance(token, tuple) else token
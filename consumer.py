@@ -0,0 +1,239 @@
+#! /usr/bin/env python2.7
+
+'''
+Hand the delivered messages to application code, in batches.
+
+A handler is any callable, named by a dotted path (package.module:function
+or package.module.function); it gets a list of messages, each a dict with:
+gist, sender (the Keybase signer), trace, sent, queued, delivered (seconds
+since the epoch), lane and text (the plain-text).
+
+    def handle(messages):
+        ...
+
+A handler decorated with @asynchronous gets a callback as well and returns
+right away; it calls done() (or done(error)) once the batch is processed.
+Up to in_flight batches are processed at a time.
+
+    @asynchronous
+    def handle(messages, done):
+        ...
+
+Messages wait in a bounded buffer; a batch is handed over when it holds
+batch_size messages or the first one has waited linger seconds. When the
+buffer is full (the handler is behind) the pull loop stops taking jobs,
+and they stay in disque.
+
+The job of a message is only acknowledged once the handler returned (or
+called done()); if it failed, the jobs of the batch are NACKed, and disque
+delivers them again.
+'''
+
+import time
+import importlib
+import threading
+from Queue import Queue, Empty, Full
+from logging import NullHandler, getLogger
+
+from metrics import REGISTRY
+
+# Logging is configured by log.setup() in main().
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Messages buffered for the handler, batches handled concurrently (async).
+PENDING, IN_FLIGHT = 100, 2
+
+# Metrics.
+BATCHES = REGISTRY.histogram('bus_handler_batch_size',
+                             'Messages per batch handed to the handler',
+                             bounds=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+DURATION = REGISTRY.histogram('bus_handler_duration_seconds',
+                              'Time the handler took per batch')
+FAILED = REGISTRY.counter('bus_handler_failures_total',
+                          'Messages in the batches the handler failed')
+BUFFERED = REGISTRY.gauge('bus_handler_pending',
+                          'Messages waiting for the handler')
+
+# Marks the end of the messages (see Consumer.close).
+STOP = object()
+
+
+def asynchronous(handler):
+    '''
+    Mark a handler as asynchronous: it is called as handler(messages, done).
+    '''
+    handler.asynchronous = True
+    return handler
+
+
+def load(path):
+    '''
+    The handler at a dotted path (module:name or module.name); raises a
+    ValueError if there is none.
+    '''
+    if ':' in path:
+        module, _, name = path.partition(':')
+    else:
+        module, _, name = path.rpartition('.')
+    if not module or not name:
+        raise ValueError('invalid handler: {0}'.format(path))
+    try:
+        handler = getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError) as _error:
+        raise ValueError('unable to load handler {0}: {1}'.format(path,
+                                                                  _error))
+    if not callable(handler):
+        raise ValueError('handler is not callable: {0}'.format(path))
+    return handler
+
+
+def settle(batch, error=None):
+    '''
+    Report the outcome of a batch of (message, ack) pairs to the acks: None
+    once it was handled, the error if the handler failed on it.
+    '''
+    if error is not None:
+        LOGGER.error('[handler] failed on %d messages: %s', len(batch),
+                     error)
+        FAILED.inc(len(batch))
+    for _, ack in batch:
+        if ack is None:
+            continue
+        try:
+            ack(error)
+        except Exception as _error:
+            LOGGER.error('[handler] unable to settle a job: %s', _error)
+
+
+class Consumer(object):
+    '''
+    Batch the messages for a handler, in a background thread.
+    '''
+    def __init__(self, handler, batch_size=1, linger=0.0, **kwargs):
+        pending = kwargs['pending'] if 'pending' in kwargs else PENDING
+        in_flight = kwargs['in_flight'] if 'in_flight' in kwargs else \
+            IN_FLIGHT
+
+        self.handler = handler
+        self.batch_size = max(batch_size, 1)
+        self.linger = max(linger, 0.0)
+        self.messages = Queue(maxsize=max(pending, self.batch_size))
+        self.in_flight = max(in_flight, 1)
+        self.slots = None
+        if getattr(handler, 'asynchronous', False):
+            self.slots = threading.Semaphore(self.in_flight)
+        self.thread = threading.Thread(target=self.dispatch,
+                                       name='consumer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, message, ack=None):
+        '''
+        Queue a message for the handler; blocks while the buffer is full.
+        The ack (if any) is called with the outcome (see settle).
+        '''
+        self.messages.put((message, ack))
+        BUFFERED.set(self.messages.qsize())
+
+    def batch(self):
+        '''
+        The next batch of (message, ack) pairs (blocks for the first one);
+        None once stopped.
+        '''
+        message = self.messages.get()
+        if message is STOP:
+            return None
+        batch, deadline = [message], time.time() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    message = self.messages.get(timeout=remaining)
+                else:
+                    message = self.messages.get_nowait()
+            except Empty:
+                break
+            if message is STOP:
+                # Handle what is left, then stop.
+                self.messages.put(STOP)
+                break
+            batch.append(message)
+        BUFFERED.set(self.messages.qsize())
+        return batch
+
+    def dispatch(self):
+        '''
+        Hand the batches over, until stopped.
+        '''
+        while True:
+            batch = self.batch()
+            if batch is None:
+                return
+            BATCHES.observe(len(batch))
+            if self.slots is None:
+                settle(batch, self.call(batch))
+            else:
+                # Wait for a slot; meanwhile the buffer fills up.
+                self.slots.acquire()
+                self.call(batch, self.callback(batch, time.time()))
+
+    def call(self, batch, *args):
+        '''
+        Run the handler on a batch; returns the error it raised (if any).
+        '''
+        start = time.time()
+        try:
+            self.handler([_[0] for _ in batch], *args)
+        except Exception as _error:
+            if args:
+                args[0](_error)
+            return _error
+        if not args:
+            DURATION.observe(time.time() - start)
+        return None
+
+    def callback(self, batch, start):
+        '''
+        The done(error=None) callback of an asynchronous batch; only the
+        first call counts.
+        '''
+        called = []
+        lock = threading.Lock()
+
+        def done(error=None):
+            with lock:
+                if called:
+                    return
+                called.append(True)
+            DURATION.observe(time.time() - start)
+            settle(batch, error)
+            self.slots.release()
+        return done
+
+    def close(self, timeout=None):
+        '''
+        Hand over the buffered messages and wait (up to timeout seconds)
+        for the handler to finish them; the jobs of what is left are not
+        acknowledged, disque delivers them again.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+
+        def remaining():
+            return None if deadline is None else \
+                max(deadline - time.time(), 0)
+
+        try:
+            self.messages.put(STOP, timeout=remaining())
+        except Full:
+            LOGGER.warning('[handler] still behind; %d messages left',
+                           self.messages.qsize())
+            return
+        self.thread.join(remaining())
+        if self.slots is None or self.thread.is_alive():
+            return
+        for _ in range(self.in_flight):
+            while not self.slots.acquire(False):
+                if deadline is not None and time.time() > deadline:
+                    return
+                time.sleep(0.05)
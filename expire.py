@@ -2,54 +2,69 @@
 
 '''
 Handle deletion of tweets/gists based on their expiry.
-Listens to disque on the 'out' queue.
+Listens to disque on the 'out' queue (and its lanes; deletions due soon
+are polled more often than the ones due in days).
 Spawn any number of instances of this module to achieve parallel deletions.
 Servicing jobs is done in a round-robin manner.
 '''
 
-import time
 import json
 from datetime import datetime
 from argparse import ArgumentParser
-from logging import (NullHandler, getLogger, StreamHandler, Formatter, DEBUG,
-                     INFO)
-
-import tweepy
-from pydisque.client import Client
+from logging import NullHandler, getLogger, DEBUG
 
+from log import setup
+from config import load_credentials
 from gist import delete
+from ratelimit import LIMITER, DELETE, twitter
+from metrics import REGISTRY, serve, dequeued
+from routing import Schedule
+from polling import Poller
 
-# Formatting for logger output.
+# Logging is configured by log.setup() in main().
 getLogger(__name__).addHandler(NullHandler())
-LOGGER = getLogger()
-HANDLER = StreamHandler()
-FORMATTER = Formatter(
-    ('%(asctime)s; %(name)s, %(levelname)s; PID: %(process)s; '
-     '%(module)s: %(funcName)s; traceback: %(exc_info)s; %(message)s')
-)
-HANDLER.setFormatter(FORMATTER)
+LOGGER = getLogger(__name__)
 
-# Check stream.py for more information.
-VAULT_PATH = 'vault/keys.json'
+# Metrics.
+REMOVE_LATENCY = dict((what, REGISTRY.histogram('bus_expire_remove_seconds',
+                                                'Time spent deleting',
+                                                what=what))
+                      for what in ('gist', 'tweet'))
+LAG = REGISTRY.histogram('bus_expiry_lag_seconds',
+                         'Delay between the expiry time and the deletion')
 
 
 def remove(what, which, auth, debug=False):
     '''
-    Delete a gist/tweet, based on the given ID.
+    Delete a gist/tweet, based on the given ID; True if it is gone (or
+    was already).
     '''
     flag = None
     LOGGER.info('[req-delete-%s] %s', what, which)
 
     if what == 'gist':
-        flag = delete(which, auth, debug)
+        with REMOVE_LATENCY['gist'].time():
+            flag = delete(which, auth, debug)
     elif what == 'tweet':
-        _flag = auth.destroy_status(which)
-        LOGGER.debug('[debug-delete-tweet] %s', _flag)
-        flag = True or _flag
+        try:
+            with REMOVE_LATENCY['tweet'].time():
+                _flag = twitter(auth, 'statuses/destroy', 'destroy_status',
+                                which, priority=DELETE)
+            LOGGER.debug('[debug-delete-tweet] %s', _flag)
+            flag = True
+        except Exception as _error:
+            # Already deleted (404) counts as gone.
+            response = getattr(_error, 'response', None)
+            flag = getattr(response, 'status_code', None) == 404
+            if not flag:
+                LOGGER.error('[delete-tweet] %s: %s', which, _error)
     else:
         LOGGER.error('[delete] unknown-entity')
 
     LOGGER.info('[status-delete-%s-%s] %s', what, which, flag)
+    if LOGGER.isEnabledFor(DEBUG):
+        LOGGER.debug('[rate-limit-budget] %s', LIMITER.budget())
+    return flag
 
 
 def listen(queue, tokens, debug=False, retry=8):
@@ -58,30 +73,41 @@ def listen(queue, tokens, debug=False, retry=8):
     else NACK.
     Currently, the retry is set to N = 3, so hit ^C thrice to get out.
     '''
+    schedule = Schedule(['out'])
+    poller = Poller('expire', retry)
     try:
         while True:
-            job = queue.get_job(['out'], count=1, nohang=False)
+            job = poller.poll(queue, schedule.next())
             auth = None
             # Wait for a message.
             if len(job) > 0:
-                LOGGER.info('[processing] %s', repr(job[0]))
+                dequeued(queue, job[0][0])
+                LOGGER.info('[processing] %r', job[0])
                 try:
                     what, which, timestamp = job[0][2].split('~')
-                except IndexError:
+                    future = int(timestamp)
+                    if what not in ('gist', 'tweet'):
+                        raise ValueError(what)
+                except ValueError:
                     queue.ack_job(job[0][1])
                     LOGGER.error('[queue] invalid message!')
                     continue
-                future, now = (int(timestamp),
-                               int(datetime.utcnow().strftime('%s')))
+                now = int(datetime.utcnow().strftime('%s'))
                 # Compare timestamps.
                 if future <= now:
                     if what == 'gist':
                         auth = tokens[0]
                     elif what == 'tweet':
                         auth = tokens[1]
-                    # Delete the tweet/gist.
-                    remove(what, which, auth, debug)
-                    queue.ack_job(job[0][1])
+                    # Delete the tweet/gist; if it is still there, disque
+                    # delivers the job again.
+                    if remove(what, which, auth, debug):
+                        queue.ack_job(job[0][1])
+                        LAG.observe(now - future)
+                        poller.busy()
+                    else:
+                        queue.nack_job(job[0][1])
+                        poller.idle()
 
                 else:
                     LOGGER.info('[push-back] ttl-diff-seconds: %d',
@@ -90,8 +116,11 @@ def listen(queue, tokens, debug=False, retry=8):
                     # queue.
                     queue.ack_job(job[0][1])
                     queue.del_job(job[0][1])
-                    queue.add_job('out', job[0][2])
-            time.sleep(retry)
+                    queue.add_job(job[0][0], job[0][2])
+                    # Nothing was due; don't spin on the same jobs.
+                    poller.idle()
+            else:
+                poller.idle()
 
     except Exception as _error:
         LOGGER.error('[delete-error] %s', _error)
@@ -100,29 +129,6 @@ def listen(queue, tokens, debug=False, retry=8):
         return
 
 
-def load_credentials(path=VAULT_PATH):
-    '''
-    Load credentials from vault.
-    '''
-    gist, api = None, None
-    with open(path, 'r') as vault_file:
-        try:
-            vault = json.loads(vault_file.read())
-            auth = tweepy.OAuthHandler(vault['twitter']['consumer-key'],
-                                       vault['twitter']['consumer-secret'])
-            auth.set_access_token(vault['twitter']['access-token'],
-                                  vault['twitter']['access-token-secret'])
-            api = tweepy.API(auth)
-            gist = vault['github']
-
-        except IOError:
-            print 'Unable to read vault-file: {0}.'.format(path)
-        except (KeyError, ValueError):
-            print 'Unable to parse the vault-file.'
-
-    return gist, api
-
-
 def main():
     '''
     Initialize authentication, client connection.
@@ -130,7 +136,10 @@ def main():
     message = 'Delete gists, tweets if a TTL is set.'
     socket_help = ('a list containing the host, port numbers to listen to; '
                    'defaults to localhost:7711 (for disque)')
-    retry_help = 'queue check frequncy (in seconds); defaults to 8'
+    retry_help = ('longest wait between polls while the queue is idle (in '
+                  'seconds); defaults to 8')
+    metrics_help = ('expose metrics on this local HTTP port; '
+                    'disabled by default')
 
     parser = ArgumentParser(description=message)
     parser.add_argument('-s', '--sockets', help=socket_help,
@@ -138,17 +147,19 @@ def main():
                         metavar=('HOST:PORT'), nargs='+')
     parser.add_argument('-d', '--debug', help='enable debugging',
                         action='store_true', default=False)
+    parser.add_argument('-j', '--json-logs', help='log in JSON (per line)',
+                        action='store_true', default=False)
     parser.add_argument('-r', '--retry', help=retry_help, default=8,
                         type=int, metavar=('DELAY'))
+    parser.add_argument('-m', '--metrics-port', help=metrics_help,
+                        default=None, type=int, metavar=('PORT'))
 
     args = vars(parser.parse_args())
 
-    if args['debug']:
-        LOGGER.setLevel(DEBUG)
-        LOGGER.addHandler(HANDLER)
-    else:
-        LOGGER.setLevel(INFO)
-        LOGGER.addHandler(HANDLER)
+    setup(debug=args['debug'], structured=args['json_logs'])
+
+    if args['metrics_port']:
+        serve(args['metrics_port'])
 
     # Load the credentials.
     tokens = load_credentials()
@@ -159,11 +170,13 @@ def main():
 
     try:
         # Connect to the redis-queue.
-        queue = Client(args['sockets'])
+        from cluster import Cluster
+        queue = Cluster(args['sockets'])
         queue.connect()
         LOGGER.info('[start-daemon]')
-        queue_info = json.dumps(queue.info(), indent=4)
-        LOGGER.debug('[queue-init]\n%s', queue_info)
+        if LOGGER.isEnabledFor(DEBUG):
+            LOGGER.debug('[queue-init]\n%s',
+                         json.dumps(queue.info(), indent=4))
         listen(queue, tokens, args['debug'], args['retry'])
 
     except Exception:
@@ -7,11 +7,19 @@ Post, fetch or delete a gist (containing the keybase-saltpack) on GitHub.
 import os
 import json
 import hashlib
+import time
+import threading
+from urllib import urlencode
 from socket import getfqdn
 from getpass import getuser
 from datetime import datetime
+from logging import NullHandler, getLogger
 
-import requests
+from ratelimit import LIMITER, SEND, DELETE, account_of
+from metrics import REGISTRY
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
 
 # API URL, headers.
 GITHUB_API_URL = 'https://api.github.com'
@@ -19,6 +27,30 @@ GITHUB_HEADERS = {
     'Accept': 'application/vnd.github.v3.raw+json'
 }
 
+# Gists per page, when listing them (GitHub's maximum).
+PAGE_SIZE = 100
+
+# Metrics (per HTTP method).
+LATENCY = dict((http, REGISTRY.histogram('bus_gist_request_seconds',
+                                         'Latency of GitHub API requests',
+                                         method=http))
+               for http in ('get', 'post', 'delete'))
+ERRORS = REGISTRY.counter('bus_gist_errors_total',
+                          'Failed GitHub API requests')
+
+# Connections to the API are kept alive and shared by all the threads of a
+# process (see session); at most this many per host.
+POOL_SIZE = 10
+SESSION = {}
+SESSION_LOCK = threading.Lock()
+
+
+class Unavailable(Exception):
+    '''
+    GitHub could not be reached, failed (5xx) or kept throttling the
+    request; it may succeed later.
+    '''
+
 
 def http_debug(response):
     '''
@@ -44,37 +76,104 @@ def http_debug(response):
                                                          indent=4)
 
 
-def github(http, uri, token, payload, debug=False):
+def throttled(response):
+    '''
+    Check if GitHub refused the request because of the rate-limit (the
+    primary one: an empty budget; or a secondary one: a Retry-After).
+    '''
+    if response.status_code == 429:
+        return True
+    return (response.status_code == 403 and
+            (response.headers.get('X-RateLimit-Remaining') == '0' or
+             'Retry-After' in response.headers))
+
+
+def session(size=POOL_SIZE):
     '''
-    Make an HTTP request to the GitHub API.
+    The (pooled) requests.Session of the process; created on first use,
+    with a pool of the given size.
+    '''
+    with SESSION_LOCK:
+        if 'http' not in SESSION:
+            # Imported here; requests takes a large share of the start-up
+            # time.
+            import requests
+            http = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=size)
+            http.mount('https://', adapter)
+            http.mount('http://', adapter)
+            SESSION['http'] = http
+    return SESSION['http']
+
+
+def github(http, uri, token, payload, debug=False, priority=SEND, retries=2):
+    '''
+    Make an HTTP request to the GitHub API (within the rate-limit); returns
+    the reply (the error message of a 4xx), {} if it has no body (204).
+    Raises Unavailable if GitHub could not be reached, failed or kept
+    throttling the request.
     '''
     if uri is not None:
         url = '/'.join([GITHUB_API_URL, uri.lstrip('/')])
 
+    # A copy per request; the threads of a process share GITHUB_HEADERS.
+    headers = dict(GITHUB_HEADERS)
     if token is not None:
-        GITHUB_HEADERS.update({'Authorization': ' '.join(['token', token])})
+        headers['Authorization'] = ' '.join(['token', token])
 
-    request = getattr(requests, http)
+    import requests
+    request = getattr(session(), http)
+    account = account_of(token)
 
     try:
-        response = request(url, data=payload, headers=GITHUB_HEADERS)
-        if debug:
-            http_debug(response)
-        return response.json()
-    except (requests.exceptions.RequestException, ValueError):
+        for attempt in range(retries + 1):
+            LIMITER.acquire('github', account, priority)
+            with LATENCY[http].time():
+                response = request(url, data=payload, headers=headers)
+            if debug:
+                http_debug(response)
+            limited = throttled(response)
+            LIMITER.update('github', account, response.headers,
+                           throttled=limited)
+            if not limited or attempt == retries:
+                break
+    except requests.exceptions.RequestException as _error:
+        ERRORS.inc()
+        raise Unavailable('{0} {1}: {2}'.format(http.upper(), uri, _error))
+
+    if response.status_code >= 400:
+        ERRORS.inc()
+    if limited or response.status_code >= 500:
+        raise Unavailable('{0} {1}: HTTP {2}'.format(http.upper(), uri,
+                                                    response.status_code))
+    if response.status_code == 204:
         return {}
+    try:
+        return response.json()
+    except ValueError:
+        raise Unavailable('{0} {1}: invalid reply (HTTP {2})'.format(
+            http.upper(), uri, response.status_code))
 
 
-def post(content, token=None, username=None, public=False, debug=False):
+def post(content, token=None, username=None, public=False, debug=False,
+         digest=None, expires=None):
     '''
-    Post a gist on GitHub.
+    Post a gist on GitHub; the digest (random, by default) tags the gist,
+    the expiry (seconds since the epoch, if any) is noted in it for
+    reconcile.
     '''
-    random = hashlib.sha1(os.urandom(16)).hexdigest()
+    random = hashlib.sha1(os.urandom(16)).hexdigest() if digest is None \
+        else digest
     username = getuser() if username is None else username
     now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
     description = ('{hash} (twitter-message-bus); from {host} by {user} '
-                   'at {time} UTC.').format(host=getfqdn(), user=username,
-                                            time=now, hash=random)
+                   'at {time} UTC').format(host=getfqdn(), user=username,
+                                           time=now, hash=random)
+    if expires is not None:
+        description += '; expires at {0}'.format(
+            time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(expires)))
+    description += '.'
 
     payload = json.dumps({
         'files': {
@@ -86,14 +185,20 @@ def post(content, token=None, username=None, public=False, debug=False):
         'description': description
     })
 
-    response = github(http='post', uri='gists', token=token, payload=payload,
-                      debug=debug)
+    try:
+        response = github(http='post', uri='gists', token=token,
+                          payload=payload, debug=debug)
+    except Unavailable as _error:
+        LOGGER.error('[gist-post] %s', _error)
+        return None, None
     return (response['id'], random) if 'id' in response else (None, None)
 
 
 def get(gist_id, token=None, debug=False):
     '''
-    Get the contents of the gist from GitHub.
+    Get the contents of the gist from GitHub; None if there is no such
+    gist (or it can't be read). Raises Unavailable if GitHub is (see
+    github), the gist may be there.
     '''
     response = github(http='get', uri='gists/{0}'.format(gist_id), token=token,
                       payload=None, debug=debug)
@@ -105,8 +210,34 @@ def get(gist_id, token=None, debug=False):
 
 def delete(gist_id, token=None, debug=False):
     '''
-    Delete a gist from GitHub.
+    Delete a gist from GitHub; True if it is gone (204), or was already
+    (404).
     '''
-    response = github(http='delete', uri='gists/{0}'.format(gist_id),
-                      token=token, payload=None, debug=debug)
-    return True if response == {} else False
+    try:
+        response = github(http='delete', uri='gists/{0}'.format(gist_id),
+                          token=token, payload=None, debug=debug,
+                          priority=DELETE)
+    except Unavailable as _error:
+        LOGGER.error('[gist-delete] %s', _error)
+        return False
+    return response == {} or response.get('message') == 'Not Found'
+
+
+def listing(token=None, since=None, page=1, debug=False):
+    '''
+    A page of the account's gists, most recently updated first; since (an
+    ISO 8601 timestamp) leaves out the ones not updated after it. None if
+    the request failed.
+    '''
+    query = [('per_page', PAGE_SIZE), ('page', page)]
+    if since is not None:
+        query.append(('since', since))
+    try:
+        response = github(http='get',
+                          uri='gists?{0}'.format(urlencode(query)),
+                          token=token, payload=None, debug=debug,
+                          priority=DELETE)
+    except Unavailable as _error:
+        LOGGER.error('[gist-list] %s', _error)
+        return None
+    return response if isinstance(response, list) else None
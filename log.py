@@ -0,0 +1,160 @@
+#! /usr/bin/env python2.7
+
+'''
+Shared logging setup for all the modules; plain-text or JSON (one object
+per line) output, written by a background thread so that slow I/O never
+blocks the stream/queue threads, and sampling for high-volume events.
+
+Modules log through getLogger(__name__) with lazy %-style arguments; the
+entry points call setup() once.
+'''
+
+import sys
+import json
+import atexit
+import threading
+from Queue import Queue, Full
+from logging import (NullHandler, getLogger, Handler, StreamHandler,
+                     Formatter, DEBUG, INFO)
+
+from metrics import REGISTRY
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Formatting for (plain-text) logger output.
+FORMAT = ('%(asctime)s; %(name)s, %(levelname)s; PID: %(process)s; '
+          '%(module)s: %(funcName)s; %(message)s')
+
+# Records waiting to be written; beyond this, records are dropped.
+BACKLOG = 10000
+
+# Metrics.
+DROPPED = REGISTRY.counter('bus_log_dropped_total',
+                           'Log records dropped while the writer was behind')
+
+
+class JSONFormatter(Formatter):
+    '''
+    Format a record as a single-line JSON object.
+    '''
+    def format(self, record):
+        '''
+        Only include the traceback when there is one.
+        '''
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'module': record.module,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['traceback'] = record.exc_text
+        return json.dumps(entry, sort_keys=True)
+
+
+class AsyncHandler(Handler):
+    '''
+    Hand records over to a background thread which writes them to the
+    target handler; the caller only pays for a queue put.
+    '''
+    def __init__(self, target, backlog=BACKLOG):
+        Handler.__init__(self)
+        self.target = target
+        self.records = Queue(maxsize=backlog)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.drain, name='logging')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def prepare(self, record):
+        '''
+        Render the message and the traceback now, while the arguments and
+        the exception are current; the writer only formats strings.
+        '''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                formatter = self.target.formatter or Formatter()
+                record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        '''
+        Queue the record; drop it (and count) if the writer is behind.
+        '''
+        try:
+            self.records.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+            DROPPED.inc()
+        except Exception:
+            self.handleError(record)
+
+    def drain(self):
+        '''
+        Write records until a None (sentinel) is received.
+        '''
+        while True:
+            record = self.records.get()
+            if record is None:
+                break
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+
+    def close(self):
+        '''
+        Flush the pending records, stop the writer.
+        '''
+        if self.thread.is_alive():
+            self.records.put(None)
+            self.thread.join()
+        if self.dropped:
+            sys.stderr.write('logging: dropped {0} records\n'.format(
+                self.dropped))
+        self.target.close()
+        Handler.close(self)
+
+
+class Sample(object):
+    '''
+    Let one in every N events through; use as a guard for high-volume log
+    calls: `if SAMPLE(): LOGGER.info(...)`.
+    '''
+    __slots__ = ('every', 'seen')
+
+    def __init__(self, every):
+        self.every, self.seen = max(int(every), 1), 0
+
+    def __call__(self):
+        self.seen += 1
+        return self.seen % self.every == 1 or self.every == 1
+
+
+def setup(debug=False, structured=False, stream=None):
+    '''
+    Configure the root logger (once per process).
+    '''
+    root = getLogger()
+    target = StreamHandler(stream)
+    target.setFormatter(JSONFormatter() if structured else Formatter(FORMAT))
+    handler = AsyncHandler(target)
+
+    for existing in root.handlers[:]:
+        if isinstance(existing, AsyncHandler):
+            root.removeHandler(existing)
+            existing.close()
+
+    root.addHandler(handler)
+    root.setLevel(DEBUG if debug else INFO)
+    atexit.register(handler.close)
+    return handler
@@ -0,0 +1,323 @@
+#! /usr/bin/env python2.7
+
+'''
+A lightweight metrics registry (counters, gauges, histograms) shared by all
+the modules; exposed in the Prometheus text format on an optional local
+HTTP port.
+
+Updates are plain attribute arithmetic (no locks, no allocations), relying
+on the GIL; an occasional lost increment under heavy contention is the
+price for keeping the hot paths cheap.
+'''
+
+import time
+import bisect
+import threading
+from functools import wraps
+from logging import NullHandler, getLogger
+
+from ratelimit import LIMITER
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Default histogram buckets (in seconds).
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+
+def render_labels(labels):
+    '''
+    Format a label-set as {key="value",...}.
+    '''
+    if not labels:
+        return ''
+    pairs = ','.join('{0}="{1}"'.format(key, str(value).replace('"', '\\"'))
+                     for key, value in labels)
+    return '{' + pairs + '}'
+
+
+class Counter(object):
+    '''
+    A monotonically increasing value.
+    '''
+    kind = 'counter'
+    __slots__ = ('name', 'labels', 'value')
+
+    def __init__(self, name, labels):
+        self.name, self.labels, self.value = name, labels, 0
+
+    def inc(self, amount=1):
+        '''
+        Increment the counter.
+        '''
+        self.value += amount
+
+    def samples(self):
+        '''
+        Yield (name, labels, value) for the exposition.
+        '''
+        yield self.name, self.labels, self.value
+
+
+class Gauge(Counter):
+    '''
+    A value that can go up and down.
+    '''
+    kind = 'gauge'
+    __slots__ = ()
+
+    def set(self, value):
+        '''
+        Set the gauge.
+        '''
+        self.value = value
+
+    def dec(self, amount=1):
+        '''
+        Decrement the gauge.
+        '''
+        self.value -= amount
+
+
+class Histogram(object):
+    '''
+    Count observations into fixed buckets.
+    '''
+    kind = 'histogram'
+    __slots__ = ('name', 'labels', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, name, labels, bounds=BUCKETS):
+        self.name, self.labels, self.bounds = name, labels, bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value):
+        '''
+        Record an observation.
+        '''
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        '''
+        Context manager, observes the time spent in the block.
+        '''
+        return Timer(self)
+
+    def samples(self):
+        '''
+        Yield cumulative buckets, sum and count for the exposition.
+        '''
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            edge = '+Inf' if bound == float('inf') else repr(bound)
+            yield (self.name + '_bucket', self.labels + (('le', edge),),
+                   total)
+        yield self.name + '_sum', self.labels, self.sum
+        yield self.name + '_count', self.labels, self.count
+
+
+class Timer(object):
+    '''
+    Observe the wall-clock duration of a block into a histogram.
+    '''
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram, self.start = histogram, None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.time() - self.start)
+
+
+class Registry(object):
+    '''
+    Holds every metric of the process, keyed by name and label-set.
+    '''
+    def __init__(self):
+        self.metrics = {}
+        self.docs = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, doc, labels, **kwargs):
+        '''
+        Get (or create) a metric.
+        '''
+        labels = tuple(sorted(labels.items()))
+        key = (name, labels)
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = cls(name, labels, **kwargs)
+                    self.metrics[key] = metric
+                    self.docs.setdefault(name, (cls.kind, doc))
+        return metric
+
+    def counter(self, name, doc='', **labels):
+        '''
+        Get (or create) a counter.
+        '''
+        return self.get(Counter, name, doc, labels)
+
+    def gauge(self, name, doc='', **labels):
+        '''
+        Get (or create) a gauge.
+        '''
+        return self.get(Gauge, name, doc, labels)
+
+    def histogram(self, name, doc='', bounds=BUCKETS, **labels):
+        '''
+        Get (or create) a histogram.
+        '''
+        return self.get(Histogram, name, doc, labels, bounds=bounds)
+
+    def collector(self, function):
+        '''
+        Register a function that updates gauges at scrape time.
+        '''
+        self.collectors.append(function)
+        return function
+
+    def render(self):
+        '''
+        Render all the metrics in the Prometheus text format.
+        '''
+        for function in self.collectors:
+            try:
+                function(self)
+            except Exception as error:
+                LOGGER.warning('[metrics] collector failed: %s', error)
+
+        lines, seen = [], set()
+        for (name, _), metric in sorted(self.metrics.items()):
+            if name not in seen:
+                kind, doc = self.docs[name]
+                if doc:
+                    lines.append('# HELP {0} {1}'.format(name, doc))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                seen.add(name)
+            for sample, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(sample,
+                                                 render_labels(labels),
+                                                 value))
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by every module in the process.
+REGISTRY = Registry()
+
+
+def timed(name, doc='', registry=REGISTRY, **labels):
+    '''
+    Decorator; observe the duration of every call into a histogram.
+    '''
+    histogram = registry.histogram(name, doc, **labels)
+
+    def decorator(function):
+        '''
+        Wrap the function.
+        '''
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            '''
+            Time the call.
+            '''
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.time() - start)
+        return wrapper
+    return decorator
+
+
+# The (disque) queues jobs were taken off, with a client to ask for their
+# depth at scrape time.
+QUEUES = {}
+
+
+def dequeued(queue, name):
+    '''
+    Count a job taken off the named (disque) queue.
+    '''
+    REGISTRY.counter('bus_dequeued_total', 'Jobs taken off the queue',
+                     queue=name).inc()
+    if name not in QUEUES:
+        QUEUES[name] = queue
+
+
+@REGISTRY.collector
+def queue_depth(registry):
+    '''
+    Export the depth of the queues jobs were taken off.
+    '''
+    for name, queue in QUEUES.items():
+        registry.gauge('bus_queue_depth', 'Jobs waiting in the queue',
+                       queue=name).set(queue.qlen(name))
+
+
+@REGISTRY.collector
+def rate_limit_budget(registry):
+    '''
+    Export the remaining rate-limit budget of every bucket.
+    '''
+    for bucket, budget in LIMITER.budget().items():
+        registry.gauge('bus_ratelimit_remaining',
+                       'Remaining API calls in the rate-limit window',
+                       bucket=bucket).set(budget['remaining'])
+        registry.gauge('bus_ratelimit_capacity',
+                       'API calls allowed in the rate-limit window',
+                       bucket=bucket).set(budget['capacity'])
+    for (endpoint, status), count in LIMITER.failures().items():
+        registry.counter('bus_twitter_errors_total',
+                         'Failed Twitter API requests',
+                         endpoint=endpoint, status=status).value = count
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    '''
+    Expose the registry over HTTP (GET /metrics) in a background (daemon)
+    thread; the HTTP server is only imported when enabled.
+    '''
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        '''
+        Serve the registry on GET /metrics.
+        '''
+        def do_GET(self):
+            '''
+            Respond with the rendered metrics.
+            '''
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            '''
+            Keep scrapes out of the logs.
+            '''
+            return
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    LOGGER.info('[metrics] listening on %s:%d', host, port)
+    return server
@@ -0,0 +1,365 @@
+#! /usr/bin/env python2.7
+
+'''
+Run a whole node (the stream listener, pull workers and expire workers) in
+one process; the components run as threads and share the credentials, the
+disque and GitHub connection pools, the rate limiter and the metrics.
+Incoming jobs are handed straight to an idle pull worker (if they are routed
+to its queues); disque is only used when all of them are busy.
+'''
+
+import re
+import json
+import time
+import threading
+from itertools import count
+from Queue import PriorityQueue, Full
+from argparse import ArgumentParser
+from logging import NullHandler, getLogger, DEBUG
+
+import pull
+import expire
+from log import setup
+from gist import session, Unavailable, POOL_SIZE
+from auth import status
+from config import load_credentials
+from metrics import serve, dequeued
+from routing import Router, Schedule, queues_of, LANES
+from polling import Poller
+from tracing import TRACER
+from archive import Archive
+from consumer import Consumer, load, PENDING
+
+# Logging is configured by log.setup() in main().
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Pause of a pull worker after GitHub failed (in seconds); its job was
+# NACKed and comes back.
+PAUSE = 2
+
+# Pause before an expire worker which gave up is started again (in seconds).
+RESTART = 5
+
+
+class Handoff(object):
+    '''
+    The in-process queue between the listener and the pull workers (for
+    the queues they read, by priority lane); it holds at most capacity
+    jobs (the rest go through disque), so a crash loses no more than that.
+    Jobs offered by the listener are added to disque (the client) if they
+    fail.
+    '''
+    def __init__(self, capacity, queues=None, client=None):
+        self.capacity = capacity
+        self.client = client
+        self.schedule = Schedule(queues or queues_of(None))
+        self.ranks = dict((name, LANES.index(lane))
+                          for lane, names in self.schedule.lanes.items()
+                          for name in names)
+        self.order = count()
+        self.jobs = PriorityQueue(maxsize=max(capacity, 1))
+
+    def put(self, queue, job, block=True, ack=None):
+        '''
+        Queue a job for the workers, with the ack of its disque job (if it
+        came from disque, see pull.settle); higher lanes are taken first.
+        '''
+        self.jobs.put((self.ranks[queue], next(self.order), (job, ack)),
+                      block)
+
+    def take(self):
+        '''
+        The next job and its ack for a worker (blocks).
+        '''
+        return self.jobs.get()[2]
+
+    def offer(self, queue, job):
+        '''
+        Take the job if it is for the workers and there is room for it;
+        False otherwise.
+        '''
+        if not self.capacity or queue not in self.ranks:
+            return False
+        try:
+            self.put(queue, job, block=False,
+                     ack=pull.requeue(self.client, queue, job)
+                     if self.client is not None else None)
+        except Full:
+            return False
+        return True
+
+
+def spawn(target, *args):
+    '''
+    Run the target in a daemon thread.
+    '''
+    thread = threading.Thread(target=target, args=args,
+                              name=getattr(target, '__name__', None))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def supervise(target, *args):
+    '''
+    Run the target again, after a pause, whenever it returns or raises;
+    for loops which give up on errors (expire.listen does, once disque
+    stays unreachable).
+    '''
+    name = getattr(target, '__name__', target)
+    while True:
+        try:
+            target(*args)
+            LOGGER.error('[node] %s stopped; restarting in %d seconds', name,
+                         RESTART)
+        except Exception as _error:
+            LOGGER.error('[node] %s failed: %s; restarting in %d seconds',
+                         name, _error, RESTART)
+        time.sleep(RESTART)
+
+
+def feed(queue, handoff, retry):
+    '''
+    Move jobs from the queues of the workers to the workers, one at a
+    time, as they become idle.
+    '''
+    poller = Poller('pull', retry)
+    while True:
+        try:
+            job = poller.poll(queue, handoff.schedule.next())
+            if len(job) > 0:
+                dequeued(queue, job[0][0])
+                LOGGER.info('[received-job]: %r', job[0])
+                # Blocks until a worker has room; the job is acknowledged
+                # once it is handled, so it stays in disque (and is
+                # delivered again) if the node dies meanwhile.
+                handoff.put(job[0][0], job[0][2],
+                            ack=pull.settle(queue, job[0][1]))
+                poller.busy()
+            else:
+                poller.idle()
+        except Exception as _error:
+            LOGGER.error('[queue] unable to fetch jobs from %s: %s',
+                         ', '.join(handoff.schedule.queues), _error)
+            poller.idle()
+
+
+def work(token, handoff, debug=False, archive=None, consumer=None):
+    '''
+    A pull worker; deliver the jobs handed over by the listener or the
+    feeder.
+    '''
+    while True:
+        job, ack = handoff.take()
+        try:
+            pull.deliver(job, token, debug, archive, consumer, ack)
+        except Unavailable:
+            time.sleep(PAUSE)
+        except Exception as _error:
+            LOGGER.error('[pull] unable to deliver %s: %s', job, _error)
+
+
+def start(queue, tokens, workers=2, expirers=1, **kwargs):
+    '''
+    Start the pull and expire workers; returns the handoff for the listener
+    (None if Keybase is not available).
+    '''
+    retry = kwargs['retry'] if 'retry' in kwargs else 8
+    capacity = kwargs['handoff'] if 'handoff' in kwargs else workers
+    debug = kwargs['debug'] if 'debug' in kwargs else False
+    archive = kwargs['archive'] if 'archive' in kwargs else None
+    consumer = kwargs['consumer'] if 'consumer' in kwargs else None
+
+    # Size the GitHub connection pool for the threads which use it.
+    session(size=max(POOL_SIZE, workers + expirers + 1))
+
+    handoff = Handoff(capacity if workers else 0,
+                      queues_of(kwargs.get('recipients')), queue)
+    if workers:
+        if not status(debug):
+            LOGGER.error('[keybase-status] client-down/signed-out')
+            return None
+        LOGGER.info('[keybase-status] client-up; signed-in')
+        spawn(feed, queue, handoff, retry)
+        for _ in range(workers):
+            spawn(work, tokens, handoff, debug, archive, consumer)
+    for _ in range(expirers):
+        spawn(supervise, expire.listen, queue, tokens, debug, retry)
+    LOGGER.info('[start-node] pull-workers: %d; expire-workers: %d; '
+                'handoff: %d', workers, expirers, handoff.capacity)
+    return handoff
+
+
+def run(queue, tokens, channels, **kwargs):
+    '''
+    Start the node; the listener (if there are channels to follow) runs
+    in the calling thread.
+    '''
+    handoff = start(queue, tokens, **kwargs)
+    if handoff is None:
+        return
+
+    if channels:
+        # Imported here; tweepy is only needed for the listener.
+        from stream import StreamDaemon, Watermark, WATERMARK_PATH, follow
+        channels = [re.sub('@', '', _) for _ in channels]
+        watermark = Watermark(kwargs.get('watermark') or WATERMARK_PATH)
+        listener = StreamDaemon(queue, handoff=handoff.offer,
+                                credentials=tokens, channels=channels,
+                                watermark=watermark,
+                                router=Router(kwargs.get('routes')))
+        follow(tokens, listener, channels)
+    else:
+        while True:
+            time.sleep(60)
+
+
+def main():
+    '''
+    Validate arguments, load credentials, start the node.
+    '''
+    message = 'Run the stream, pull and expire daemons in one process.'
+    socket_help = ('a list containing the host, port numbers to listen to; '
+                   'defaults to localhost:7711 (for disque)')
+    channels_help = ('Twitter accounts to follow; the listener is not '
+                     'started without them')
+    workers_help = 'pull workers (threads); defaults to 2'
+    expirers_help = 'expire workers (threads); defaults to 1'
+    handoff_help = ('jobs held in memory for the pull workers instead of '
+                    'the \'in\' queue; defaults to the number of workers, '
+                    '0 disables')
+    retry_help = ('longest wait between polls while the queue is idle (in '
+                  'seconds); defaults to 8')
+    metrics_help = ('expose metrics on this local HTTP port; '
+                    'disabled by default')
+    trace_help = ('append latency spans (JSON lines) to this file; '
+                  'disabled by default')
+    watermark_help = ('file to keep the latest status IDs in (to catch up '
+                      'after a disconnect); defaults to vault/watermark.json')
+    routes_help = ('route announcements to recipient queues; '
+                   'SENDER[:TAG]=RECIPIENT, * matches any sender')
+    recipients_help = ('pull workers only read the queues of these '
+                       'recipients (in:KEYBASE-ID); defaults to the shared '
+                       '\'in\' queue')
+    archive_help = ('append the delivered messages to the archive in this '
+                    'directory; disabled by default')
+    handler_help = ('hand the delivered messages, in batches, to this '
+                    'function (package.module:function); see consumer.py')
+    batch_help = 'messages per batch for the handler; defaults to 1'
+    linger_help = ('wait up to this long (in seconds) to fill a batch; '
+                   'defaults to 0')
+    pending_help = ('messages buffered for the handler before taking jobs '
+                    'is paused; defaults to {0}').format(PENDING)
+
+    parser = ArgumentParser(description=message)
+    parser.add_argument('-s', '--sockets', help=socket_help,
+                        default=['localhost:7711'], dest='sockets',
+                        metavar=('HOST:PORT'), nargs='+')
+    parser.add_argument('-c', '--channels', help=channels_help,
+                        dest='channels', metavar=('CHANNEL'), nargs='+',
+                        default=[])
+    parser.add_argument('-w', '--workers', help=workers_help, default=2,
+                        type=int, metavar=('N'))
+    parser.add_argument('-x', '--expirers', help=expirers_help, default=1,
+                        type=int, metavar=('N'))
+    parser.add_argument('-H', '--handoff', help=handoff_help, default=None,
+                        type=int, metavar=('N'))
+    parser.add_argument('-d', '--debug', help='enable debugging',
+                        action='store_true', default=False)
+    parser.add_argument('-j', '--json-logs', help='log in JSON (per line)',
+                        action='store_true', default=False)
+    parser.add_argument('-r', '--retry', help=retry_help, default=8,
+                        type=int, metavar=('DELAY'))
+    parser.add_argument('-m', '--metrics-port', help=metrics_help,
+                        default=None, type=int, metavar=('PORT'))
+    parser.add_argument('-T', '--trace', help=trace_help, default=None,
+                        metavar=('FILE'))
+    parser.add_argument('-W', '--watermark', help=watermark_help,
+                        default=None, metavar=('FILE'))
+    parser.add_argument('-o', '--routes', help=routes_help, default=[],
+                        nargs='+', metavar=('RULE'))
+    parser.add_argument('-R', '--recipients', help=recipients_help,
+                        default=[], nargs='+', metavar=('KEYBASE-ID'))
+    parser.add_argument('-A', '--archive', help=archive_help, default=None,
+                        metavar=('DIRECTORY'))
+    parser.add_argument('-P', '--handler', help=handler_help, default=None,
+                        metavar=('PATH'))
+    parser.add_argument('-b', '--batch-size', help=batch_help, default=1,
+                        type=int, metavar=('N'))
+    parser.add_argument('-l', '--linger', help=linger_help, default=0.0,
+                        type=float, metavar=('SECONDS'))
+    parser.add_argument('-q', '--max-pending', help=pending_help,
+                        default=PENDING, type=int, metavar=('N'))
+
+    args = vars(parser.parse_args())
+
+    try:
+        Router(args['routes'])
+    except ValueError as _error:
+        parser.error(str(_error))
+
+    try:
+        handler = load(args['handler']) if args['handler'] else None
+    except ValueError as _error:
+        parser.error(str(_error))
+
+    setup(debug=args['debug'], structured=args['json_logs'])
+
+    if args['metrics_port']:
+        serve(args['metrics_port'])
+
+    if args['trace']:
+        TRACER.open(args['trace'], service='node')
+
+    try:
+        archive = Archive(args['archive']) if args['archive'] else None
+    except (IOError, OSError) as _error:
+        LOGGER.error('[archive] unable to open %s: %s', args['archive'],
+                     _error)
+        return
+
+    # Load the credentials.
+    tokens = load_credentials()
+
+    if None in tokens:
+        LOGGER.error('[load_credentials] unable to load credentials!')
+        return
+
+    if args['handoff'] is None:
+        args['handoff'] = args['workers']
+
+    consumer = None
+    if handler is not None:
+        consumer = Consumer(handler, args['batch_size'], args['linger'],
+                            pending=args['max_pending'])
+
+    try:
+        # Connect to the redis-queue; one client (and connection pool) is
+        # shared by all the components.
+        from cluster import Cluster
+        queue = Cluster(args['sockets'])
+        queue.connect()
+        if LOGGER.isEnabledFor(DEBUG):
+            LOGGER.debug('[queue-init]\n%s',
+                         json.dumps(queue.info(), indent=4))
+        run(queue, tokens, args['channels'], workers=args['workers'],
+            expirers=args['expirers'], handoff=args['handoff'],
+            retry=args['retry'], watermark=args['watermark'],
+            routes=args['routes'], recipients=args['recipients'],
+            archive=archive, consumer=consumer, debug=args['debug'])
+
+    except Exception:
+        LOGGER.error('[error] unable to connect to the redis-queue (disque)!')
+
+    except KeyboardInterrupt:
+        LOGGER.critical('[stop-node]')
+
+    finally:
+        # Let the handler finish the buffered messages.
+        if consumer is not None:
+            consumer.close(timeout=10)
+
+
+if __name__ == '__main__':
+    main()
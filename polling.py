@@ -0,0 +1,63 @@
+#! /usr/bin/env python2.7
+
+'''
+Adaptive polling for the queue consumers (pull, expire and the node's
+feeder). GETJOB blocks on the server for up to TIMEOUT milliseconds, so a
+job is picked up as soon as it is queued; after a job, the next poll
+follows right away. After an empty poll, the consumer waits before polling
+again; the wait doubles with every empty poll, from FLOOR up to the cap
+(-r), and drops back to 0 with the next job.
+'''
+
+import time
+from logging import NullHandler, getLogger
+
+from metrics import REGISTRY
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Server-side block per poll (in milliseconds), first wait once idle (in
+# seconds).
+TIMEOUT = 1000
+FLOOR = 0.25
+
+
+class Poller(object):
+    '''
+    Poll some queues, one job at a time; tracks the wait between polls.
+    '''
+    def __init__(self, name, cap=8, floor=FLOOR, timeout=TIMEOUT):
+        self.cap = max(cap, 0)
+        self.floor = min(floor, self.cap)
+        self.timeout = timeout
+        self.interval = 0.0
+        self.gauge = REGISTRY.gauge('bus_poll_interval_seconds',
+                                    'Wait between polls (0 while busy)',
+                                    daemon=name)
+
+    def poll(self, queue, queues):
+        '''
+        The next job from the queues (in order); an empty list if none
+        came in before the timeout.
+        '''
+        return queue.get_job(queues, timeout=self.timeout, count=1)
+
+    def busy(self):
+        '''
+        A poll found work; poll again right away.
+        '''
+        if self.interval:
+            LOGGER.debug('[poll] busy; polling without a wait')
+        self.interval = 0.0
+        self.gauge.set(0.0)
+
+    def idle(self):
+        '''
+        A poll found nothing (or failed); wait longer than the last time
+        before the next one.
+        '''
+        self.interval = min(max(self.interval * 2, self.floor), self.cap)
+        self.gauge.set(self.interval)
+        if self.interval:
+            time.sleep(self.interval)
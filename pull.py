@@ -1,57 +1,178 @@
 #! /usr/bin/env python2.7
 
 '''
-Reads messages from the 'in' queue, decrypts the contents.
+Reads messages from the 'in' queue (or the queues of the given recipients),
+decrypts the contents.
 '''
 
 import time
 import json
 from argparse import ArgumentParser
-from logging import (NullHandler, getLogger, StreamHandler, Formatter, DEBUG,
-                     INFO)
+from logging import NullHandler, getLogger, DEBUG
 
-from pydisque.client import Client
-
-from gist import get
+from log import setup
+from config import load_credentials, github_token
+from gist import get, Unavailable
 from auth import status, verify, decrypt
+from metrics import REGISTRY, serve, dequeued
+from routing import Schedule, queues_of, lane_of, LANES
+from polling import Poller
+from tracing import TRACER, seconds
+from archive import Archive
+from consumer import Consumer, load, PENDING
 
 
-# Formatting for logger output.
+# Logging is configured by log.setup() in main().
 getLogger(__name__).addHandler(NullHandler())
-LOGGER = getLogger()
-HANDLER = StreamHandler()
-FORMATTER = Formatter(
-    ('%(asctime)s; %(name)s, %(levelname)s; PID: %(process)s; '
-     '%(module)s: %(funcName)s; traceback: %(exc_info)s; %(message)s')
-)
-HANDLER.setFormatter(FORMATTER)
+LOGGER = getLogger(__name__)
+
+# Metrics.
+FAILURES = dict((stage, REGISTRY.counter('bus_pull_failures_total',
+                                         'Messages dropped, by stage',
+                                         stage=stage))
+                for stage in ('fetch', 'verify', 'decrypt'))
+DELIVERED = REGISTRY.counter('bus_pull_delivered_total',
+                             'Messages verified and decrypted')
+LATENCY = dict((lane, REGISTRY.histogram('bus_pull_latency_seconds',
+                                         'Time from push to delivery, by '
+                                         'priority lane', lane=lane))
+               for lane in LANES)
+ARCHIVE_FAILURES = REGISTRY.counter('bus_archive_failures_total',
+                                    'Delivered messages not archived')
+
+
+def envelope(body):
+    '''
+    Split a job from the 'in' queue into: gist ID, trace ID, send and
+    enqueue timestamps (in seconds) and the priority lane; older jobs only
+    carry the gist ID.
+    '''
+    fields = body.strip().split('~')
+    fields += [None] * (5 - len(fields))
+    return (fields[0], fields[1] or None, seconds(fields[2]),
+            seconds(fields[3]), lane_of(fields[4]))
+
+
+def settle(queue, job_id):
+    '''
+    The ack of a job (see consumer.settle): acknowledge it, or NACK it so
+    that disque delivers it again.
+    '''
+    def ack(error=None):
+        if error is None:
+            queue.ack_job(job_id)
+        else:
+            LOGGER.warning('[queue] %s not handled; NACKed', job_id)
+            queue.nack_job(job_id)
+    return ack
 
 
-# Check stream.py for more information.
-VAULT_PATH = 'vault/keys.json'
+def requeue(queue, name, job):
+    '''
+    The ack of a job handed over in process (it is not in disque): on an
+    error, add it to the named queue so that it is delivered again.
+    '''
+    def ack(error=None):
+        if error is not None:
+            LOGGER.warning('[queue] %s not handled; added to %s', job, name)
+            queue.add_job(name, job)
+    return ack
 
 
-def load_credentials(path=VAULT_PATH):
+def deliver(body, token, debug=False, archive=None, consumer=None, ack=None):
     '''
-    Load credentials from vault.
+    Fetch the gist of an 'in' job, verify and decrypt the message; True if
+    it was delivered. Delivered messages are appended to the archive and
+    handed to the consumer (if they are given); the latter blocks while
+    the handler is behind. The ack (if any) is called once the job is done
+    with: by the consumer, or right away. If GitHub is unavailable, the
+    ack gets the error (the job is NACKed) and Unavailable is raised, so
+    that the caller backs off.
     '''
-    gist = None
-    with open(path, 'r') as vault_file:
-        try:
-            vault = json.loads(vault_file.read())
-            gist = vault['github']
-        except IOError:
-            print 'Unable to read vault-file: {0}.'.format(path)
-        except (KeyError, ValueError):
-            print 'Unable to parse the vault-file.'
+    gist_id, trace, sent, queued, lane = envelope(body)
+    TRACER.record(trace, 'queue-wait', queued, time.time())
+    try:
+        with TRACER.span(trace, 'gist-fetch'):
+            signed = get(gist_id, github_token(token), debug)
+    except Unavailable as _error:
+        FAILURES['fetch'].inc()
+        LOGGER.error('[gist-fetch] %s: %s', gist_id, _error)
+        # The gist may well be there; try again later.
+        if ack is not None:
+            ack(_error)
+        raise
+    # Check for a valid signature.
+    if signed is None:
+        FAILURES['fetch'].inc()
+        LOGGER.error('[gist-fetch] %s not found!', body)
+        if ack is not None:
+            ack()
+        return False
+    # If the message is verified, decrypt it.
+    with TRACER.span(trace, 'verify'):
+        flag, who, encrypted = verify(signed, debug)
+
+    if flag:
+        LOGGER.info('[keybase-verify] message signed by %s', who)
+        signer = who
+        with TRACER.span(trace, 'decrypt'):
+            who, text = decrypt(encrypted, debug)
+
+        if who is not None:
+            TRACER.record(trace, 'end-to-end', sent, time.time())
+            LOGGER.info('[keybase-decrypt] message encrypted by %s', who)
+            DELIVERED.inc()
+            if sent is not None:
+                LATENCY[lane].observe(time.time() - sent)
+            LOGGER.info('[keybase-decrypt] %d bytes of plain-text',
+                        len(text or ''))
+            LOGGER.debug('[keybase-decrypt] plain-text content: \n%s', text)
+            message = {'gist': gist_id, 'sender': signer, 'trace': trace,
+                       'sent': sent, 'queued': queued,
+                       'delivered': time.time(), 'lane': lane, 'text': text}
+            if archive is not None:
+                store(archive, message)
+            if consumer is not None:
+                consumer.put(message, ack)
+            elif ack is not None:
+                ack()
+            return True
+        FAILURES['decrypt'].inc()
+        LOGGER.error('[keybase-decrypt] un-trusted encryption')
+    else:
+        FAILURES['verify'].inc()
+        LOGGER.error('[keybase-verify] unable to verify')
+    # Not for us (or not authentic); delivering it again won't help.
+    if ack is not None:
+        ack()
+    return False
 
-    return gist
+
+def store(archive, message):
+    '''
+    Append a delivered message to the archive; a failure is logged, the
+    message still counts as delivered.
+    '''
+    try:
+        offset = archive.append(message)
+        LOGGER.debug('[archive] %s at offset %d', message['gist'], offset)
+    except (IOError, OSError, ValueError) as _error:
+        ARCHIVE_FAILURES.inc()
+        LOGGER.error('[archive] unable to archive %s: %s', message['gist'],
+                     _error)
 
 
-def receive(token, queue, retry, debug=False):
+def receive(token, queue, retry, debug=False, queues=None, **kwargs):
     '''
-    Get the message from the queue, display the decrypted text.
+    Get the message from the queues ('in' by default), display the
+    decrypted text; the priority lanes of the queues are polled in a
+    weighted order, and adaptively (see polling).
     '''
+    archive = kwargs['archive'] if 'archive' in kwargs else None
+    consumer = kwargs['consumer'] if 'consumer' in kwargs else None
+    schedule = Schedule(queues or queues_of(None))
+    poller = Poller('pull', retry)
+
     if status(debug):
         LOGGER.info('[keybase-status] client-up; signed-in')
     else:
@@ -60,40 +181,25 @@ def receive(token, queue, retry, debug=False):
 
     try:
         while True:
-            job = queue.get_job(['in'], count=1, nohang=False)
+            job = poller.poll(queue, schedule.next())
 
             # Wait for a valid job.
             if len(job) > 0:
-                queue.ack_job(job[0][1])
-                LOGGER.info('[received-job]: %s', repr(job[0]))
-                signed = get(job[0][2].strip(), token, debug)
-                # Check for a valid signature.
-                if signed is None:
-                    LOGGER.error('[gist-fetch] %s not found!', job[0][2])
-                    continue
-                # If the message is verified, decrypt it.
-                flag, who, encrypted = verify(signed, debug)
-
-                if flag:
-                    LOGGER.info('[keybase-verify] message signed by %s',
-                                who)
-                    who, text = decrypt(encrypted, debug)
-
-                    if who is not None:
-                        LOGGER.info(('[keybase-decrypt] message encrypted'
-                                     ' by %s'), who)
-                        LOGGER.info(('[keybase-decrypt] plain-text content: '
-                                     '\n%s'), text)
-                    else:
-                        LOGGER.error('[keybase-decrypt] un-trusted encryption')
-                        continue
-                else:
-                    LOGGER.error('[keybase-verify] unable to verify')
-                    continue
-            time.sleep(retry)
+                dequeued(queue, job[0][0])
+                LOGGER.info('[received-job]: %r', job[0])
+                try:
+                    deliver(job[0][2], token, debug, archive, consumer,
+                            settle(queue, job[0][1]))
+                    poller.busy()
+                except Unavailable:
+                    # Don't spin on the jobs NACKed meanwhile.
+                    poller.idle()
+            else:
+                poller.idle()
 
     except Exception:
-        LOGGER.error('[queue] unable to fetch jobs from \'in\'')
+        LOGGER.error('[queue] unable to fetch jobs from %s',
+                     ', '.join(schedule.queues))
 
 
 def main():
@@ -103,7 +209,23 @@ def main():
     message = 'Read messages from the message bus.'
     socket_help = ('a list containing the host, port numbers to listen to; '
                    'defaults to localhost:7711 (for disque)')
-    retry_help = 'queue check frequncy (in seconds); defaults to 8'
+    retry_help = ('longest wait between polls while the queue is idle (in '
+                  'seconds); defaults to 8')
+    metrics_help = ('expose metrics on this local HTTP port; '
+                    'disabled by default')
+    trace_help = ('append latency spans (JSON lines) to this file; '
+                  'disabled by default')
+    recipients_help = ('only read the queues of these recipients '
+                       '(in:KEYBASE-ID); defaults to the shared \'in\' queue')
+    archive_help = ('append the delivered messages to the archive in this '
+                    'directory; disabled by default')
+    handler_help = ('hand the delivered messages, in batches, to this '
+                    'function (package.module:function); see consumer.py')
+    batch_help = 'messages per batch for the handler; defaults to 1'
+    linger_help = ('wait up to this long (in seconds) to fill a batch; '
+                   'defaults to 0')
+    pending_help = ('messages buffered for the handler before taking jobs '
+                    'is paused; defaults to {0}').format(PENDING)
 
     parser = ArgumentParser(description=message)
     parser.add_argument('-s', '--sockets', help=socket_help,
@@ -111,34 +233,73 @@ def main():
                         metavar=('HOST:PORT'), nargs='+')
     parser.add_argument('-d', '--debug', help='enable debugging',
                         action='store_true', default=False)
+    parser.add_argument('-j', '--json-logs', help='log in JSON (per line)',
+                        action='store_true', default=False)
     parser.add_argument('-r', '--retry', help=retry_help, default=8,
                         type=int, metavar=('DELAY'))
+    parser.add_argument('-m', '--metrics-port', help=metrics_help,
+                        default=None, type=int, metavar=('PORT'))
+    parser.add_argument('-T', '--trace', help=trace_help, default=None,
+                        metavar=('FILE'))
+    parser.add_argument('-R', '--recipients', help=recipients_help,
+                        default=[], nargs='+', metavar=('KEYBASE-ID'))
+    parser.add_argument('-A', '--archive', help=archive_help, default=None,
+                        metavar=('DIRECTORY'))
+    parser.add_argument('-P', '--handler', help=handler_help, default=None,
+                        metavar=('PATH'))
+    parser.add_argument('-b', '--batch-size', help=batch_help, default=1,
+                        type=int, metavar=('N'))
+    parser.add_argument('-l', '--linger', help=linger_help, default=0.0,
+                        type=float, metavar=('SECONDS'))
+    parser.add_argument('-q', '--max-pending', help=pending_help,
+                        default=PENDING, type=int, metavar=('N'))
 
     args = vars(parser.parse_args())
 
-    if args['debug']:
-        LOGGER.setLevel(DEBUG)
-        LOGGER.addHandler(HANDLER)
-    else:
-        LOGGER.setLevel(INFO)
-        LOGGER.addHandler(HANDLER)
+    try:
+        handler = load(args['handler']) if args['handler'] else None
+    except ValueError as _error:
+        parser.error(str(_error))
+
+    setup(debug=args['debug'], structured=args['json_logs'])
+
+    if args['metrics_port']:
+        serve(args['metrics_port'])
+
+    if args['trace']:
+        TRACER.open(args['trace'], service='pull')
+
+    try:
+        archive = Archive(args['archive']) if args['archive'] else None
+    except (IOError, OSError) as _error:
+        LOGGER.error('[archive] unable to open %s: %s', args['archive'],
+                     _error)
+        return
 
     # Load credentials.
     token = load_credentials()
 
-    if not token:
+    if not token.github:
         LOGGER.error('[load_credentials] unable to load credentials!')
         return
 
+    consumer = None
+    if handler is not None:
+        consumer = Consumer(handler, args['batch_size'], args['linger'],
+                            pending=args['max_pending'])
+
     try:
         # Connect to the redis-queue.
-        queue = Client(args['sockets'])
+        from cluster import Cluster
+        queue = Cluster(args['sockets'])
         queue.connect()
         LOGGER.info('[start-daemon]')
-        queue_info = json.dumps(queue.info(), indent=4)
-        LOGGER.debug('[queue-init]\n%s', queue_info)
+        if LOGGER.isEnabledFor(DEBUG):
+            LOGGER.debug('[queue-init]\n%s',
+                         json.dumps(queue.info(), indent=4))
         receive(token=token, queue=queue, retry=args['retry'],
-                debug=args['debug'])
+                debug=args['debug'], queues=queues_of(args['recipients']),
+                archive=archive, consumer=consumer)
 
     except Exception:
         LOGGER.error('[error] unable to connect to the redis-queue (disque)!')
@@ -146,6 +307,11 @@ def main():
     except KeyboardInterrupt:
         LOGGER.critical('[stop-daemon]')
 
+    finally:
+        # Let the handler finish the buffered messages.
+        if consumer is not None:
+            consumer.close(timeout=10)
+
 
 if __name__ == '__main__':
     main()
@@ -5,56 +5,26 @@ Push tweets to Twitter; if the tweet has a TTL, push it to the 'out' queue.
 '''
 
 
+import os
 import re
 import json
+import time
+import hashlib
 from datetime import datetime
 from argparse import ArgumentParser
-from logging import (NullHandler, getLogger, StreamHandler, Formatter, DEBUG,
-                     INFO)
-
-import tweepy
-import magic
-from pydisque.client import Client
+from logging import NullHandler, getLogger, DEBUG
 
+from log import setup
+from config import load_credentials
 from gist import post
 from auth import status, lookup, encrypt, sign
+from ratelimit import LIMITER, twitter
+from routing import laned, expiry_lane, LANES, NORMAL, PREFIX, PREFIX_V2
+from tracing import TRACER, millis
 
-# Formatting for logger output.
+# Logging is configured by log.setup() in main().
 getLogger(__name__).addHandler(NullHandler())
-LOGGER = getLogger()
-HANDLER = StreamHandler()
-FORMATTER = Formatter(
-    ('%(asctime)s; %(name)s, %(levelname)s; PID: %(process)s; '
-     '%(module)s: %(funcName)s; traceback: %(exc_info)s; %(message)s')
-)
-HANDLER.setFormatter(FORMATTER)
-
-
-# Check stream.py for more information.
-VAULT_PATH = 'vault/keys.json'
-
-
-def load_credentials(path=VAULT_PATH):
-    '''
-    Load credentials from vault.
-    '''
-    gist, api = None, None
-    with open(path, 'r') as vault_file:
-        try:
-            vault = json.loads(vault_file.read())
-            auth = tweepy.OAuthHandler(vault['twitter']['consumer-key'],
-                                       vault['twitter']['consumer-secret'])
-            auth.set_access_token(vault['twitter']['access-token'],
-                                  vault['twitter']['access-token-secret'])
-            api = tweepy.API(auth)
-            gist = vault['github']
-
-        except IOError:
-            print 'Unable to read vault-file: {0}.'.format(path)
-        except (KeyError, ValueError):
-            print 'Unable to parse the vault-file.'
-
-    return gist, api
+LOGGER = getLogger(__name__)
 
 
 def send(plaintext, auth, recipient, ttl=0, **kwargs):
@@ -63,8 +33,20 @@ def send(plaintext, auth, recipient, ttl=0, **kwargs):
     '''
     queue = kwargs['queue'] if 'queue' in kwargs else None
     debug = kwargs['debug'] if 'debug' in kwargs else False
+    tag = kwargs['tag'] if 'tag' in kwargs else False
+    lane = kwargs['priority'] if 'priority' in kwargs else NORMAL
+    legacy = kwargs['legacy'] if 'legacy' in kwargs else False
     future = int(datetime.utcnow().strftime('%s')) + ttl
-    prefix = 'twitter-message-bus'
+    # Deletions due soon go to a faster lane of the 'out' queue.
+    expiry = laned('out', expiry_lane(ttl))
+    prefix = PREFIX if legacy else PREFIX_V2
+
+    # The hash doubles as the trace ID of the message.
+    start = time.time()
+    trace = hashlib.sha1(os.urandom(16)).hexdigest()
+    # Noted in the gist and the tweet, so that reconcile only deletes what
+    # was sent with a TTL.
+    expires = int(start) + ttl if ttl else None
 
     if status(debug):
         LOGGER.info('[keybase-status] client-up; signed-in')
@@ -73,12 +55,16 @@ def send(plaintext, auth, recipient, ttl=0, **kwargs):
         if lookup(recipient, debug):
             LOGGER.info('[keybase-lookup] %s exists', recipient)
             # Encrypt the document.
-            encrypted = encrypt(plaintext, recipient, debug)
+            with TRACER.span(trace, 'encrypt'):
+                encrypted = encrypt(plaintext, recipient, debug)
             # Sign the document.
-            signed = sign(encrypted, debug)
+            with TRACER.span(trace, 'sign'):
+                signed = sign(encrypted, debug)
             # Post the gist.
-            gist_id, _hash = post(content=signed, username=recipient,
-                                  debug=debug, token=auth[0])
+            with TRACER.span(trace, 'gist-post'):
+                gist_id, _hash = post(content=signed, username=recipient,
+                                      debug=debug, token=auth[0],
+                                      digest=trace, expires=expires)
             if gist_id:
                 prefix = '-'.join([prefix, _hash])
                 LOGGER.info('[gist] %s', gist_id)
@@ -87,20 +73,37 @@ def send(plaintext, auth, recipient, ttl=0, **kwargs):
                 # Logic for gists/tweets with TTL.
                 if gist_id and ttl and queue and encrypted:
                     message = '~'.join(['gist', gist_id, str(future)])
-                    queue.add_job('out', message)
-                    LOGGER.info('[gist-queue] added %s to \'out\'', message)
+                    queue.add_job(expiry, message)
+                    LOGGER.info('[gist-queue] added %s to %s', message, expiry)
 
                 tweet = None
                 if gist_id:
-                    tweet = auth[1].update_status(':'.join([prefix, gist_id]))
+                    # The send timestamp rides along for latency tracing;
+                    # the recipient tag and the lane (optional) for routing;
+                    # the expiry (optional) for reconcile.
+                    fields = [prefix, gist_id]
+                    if not legacy:
+                        optional = [recipient if tag else '',
+                                    lane if lane != NORMAL else '',
+                                    str(expires) if expires else '']
+                        while optional and not optional[-1]:
+                            optional.pop()
+                        fields += [millis(start)] + optional
+                    with TRACER.span(trace, 'tweet'):
+                        tweet = twitter(auth[1], 'statuses/update',
+                                        'update_status', ':'.join(fields))
                     LOGGER.debug('[tweet] %s', tweet)
                     LOGGER.info('[tweet] %s', tweet.id)
 
                 if tweet and ttl and queue:
                     message = '~'.join(['tweet', tweet.id_str, str(future)])
-                    queue.add_job('out', message)
-                    LOGGER.info('[tweet-queue] added %s to \'out\'', message)
+                    queue.add_job(expiry, message)
+                    LOGGER.info('[tweet-queue] added %s to %s', message,
+                                expiry)
 
+                if LOGGER.isEnabledFor(DEBUG):
+                    LOGGER.debug('[rate-limit-budget] %s', LIMITER.budget())
+                TRACER.record(trace, 'send', start, time.time())
                 return gist_id, tweet.id
             except Exception:
                 LOGGER.error('[queue] unable to write to queue; data lost!')
@@ -121,6 +124,15 @@ def main():
                    'defaults to localhost:7711 (for disque)')
     ttl_help = ('a TTL (in seconds) for the data on Twitter and GitHub; '
                 'if not specified, the data will remain forever')
+    trace_help = ('append latency spans (JSON lines) to this file; '
+                  'disabled by default')
+    priority_help = ('priority lane of the message; high is delivered ahead '
+                     'of normal and low traffic; defaults to normal')
+    tag_help = ('tag the tweet with the recipient, so that it can be '
+                'routed to the recipient\'s queue (see stream -o)')
+    legacy_help = ('announce in the original format (the gist ID only), '
+                   'for listeners older than v2; no tag, priority or '
+                   'latency tracing')
 
     parser = ArgumentParser(description=message)
     parser.add_argument('-s', '--sockets', help=socket_help,
@@ -128,10 +140,20 @@ def main():
                         metavar=('HOST:PORT'), nargs='+')
     parser.add_argument('-d', '--debug', help='enable debugging',
                         action='store_true', default=False)
+    parser.add_argument('-j', '--json-logs', help='log in JSON (per line)',
+                        action='store_true', default=False)
     parser.add_argument('-r', '--recipient', help='keybase-id to send',
                         required=True, metavar=('KEYBASE-ID'))
     parser.add_argument('-t', '--ttl', help=ttl_help, default=0,
                         type=int, metavar=('N'))
+    parser.add_argument('-T', '--trace', help=trace_help, default=None,
+                        metavar=('FILE'))
+    parser.add_argument('-g', '--tag', help=tag_help,
+                        action='store_true', default=False)
+    parser.add_argument('-p', '--priority', help=priority_help,
+                        default=NORMAL, choices=LANES)
+    parser.add_argument('-L', '--legacy', help=legacy_help,
+                        action='store_true', default=False)
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-i', '--in-file', metavar=('FILE'),
                        default=None)
@@ -139,16 +161,20 @@ def main():
 
     args = vars(parser.parse_args())
 
-    if args['debug']:
-        LOGGER.setLevel(DEBUG)
-        LOGGER.addHandler(HANDLER)
-    else:
-        LOGGER.setLevel(INFO)
-        LOGGER.addHandler(HANDLER)
+    if args['legacy'] and (args['tag'] or args['priority'] != NORMAL):
+        parser.error('-g/--tag and -p/--priority need the v2 format')
+
+    setup(debug=args['debug'], structured=args['json_logs'])
+
+    if args['trace']:
+        TRACER.open(args['trace'], service='push')
 
     plaintext, queue = None, None
 
+    # Heavy dependencies (libmagic, pydisque) are only imported on the paths
+    # that need them; push runs once per message.
     if args['in_file']:
+        import magic
         name = args['in_file']
         if not re.match(r'^text\/.*', magic.from_file(name, mime=True)):
             LOGGER.error('[file-error] input-file mimetype should be text/.*')
@@ -161,10 +187,12 @@ def main():
     try:
         # Instantiate a connection to the queue only if a TTL is specified.
         if args['ttl']:
-            queue = Client(args['sockets'])
+            from cluster import Cluster
+            queue = Cluster(args['sockets'])
             queue.connect()
-            queue_info = json.dumps(queue.info(), indent=4)
-            LOGGER.debug('[queue-init]\n%s', queue_info)
+            if LOGGER.isEnabledFor(DEBUG):
+                LOGGER.debug('[queue-init]\n%s',
+                             json.dumps(queue.info(), indent=4))
 
         auth = load_credentials()
         if None in auth:
@@ -172,7 +200,9 @@ def main():
             return
 
         send(plaintext=plaintext, auth=auth, recipient=args['recipient'],
-             ttl=args['ttl'], queue=queue, debug=args['debug'])
+             ttl=args['ttl'], queue=queue, debug=args['debug'],
+             tag=args['tag'], priority=args['priority'],
+             legacy=args['legacy'])
 
     except Exception:
         LOGGER.error('[error] unable to connect to the redis-queue (disque)!')
@@ -0,0 +1,278 @@
+#! /usr/bin/env python2.7
+
+'''
+Rate-limit aware token buckets for the GitHub and Twitter APIs; buckets are
+kept per endpoint and per account, corrected from the rate-limit headers
+returned by the APIs and shared by every caller in the process.
+'''
+
+import time
+import hashlib
+import weakref
+import threading
+from logging import NullHandler, getLogger
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Priority classes; deletions (expiry) yield to sends (push, pull).
+SEND, DELETE = 0, 1
+
+# Fraction of a bucket that only SEND callers are allowed to spend.
+RESERVE = 0.1
+
+# Default (capacity, period in seconds) for each endpoint, until the API
+# tells us otherwise through the headers.
+LIMITS = {
+    'github': (5000, 3600),
+    'twitter:statuses/update': (300, 10800),
+    'twitter:statuses/destroy': (300, 900),
+    'twitter:statuses/user_timeline': (900, 900),
+}
+DEFAULT_LIMIT = (15, 900)
+
+# Header names (GitHub, Twitter).
+HEADERS = {
+    'github': ('X-RateLimit-Limit', 'X-RateLimit-Remaining',
+               'X-RateLimit-Reset'),
+    'twitter': ('x-rate-limit-limit', 'x-rate-limit-remaining',
+                'x-rate-limit-reset'),
+}
+
+# HTTP status codes which mean "slow down" (GitHub also uses a 403 with an
+# empty budget, see gist.github()).
+THROTTLED = (420, 429)
+
+# Seconds to wait when a throttled response says neither when the window
+# resets nor when to retry.
+BACKOFF = 60
+
+
+def account_of(secret):
+    '''
+    Derive a short, non-reversible account key from a token.
+    '''
+    if secret is None:
+        return 'anonymous'
+    return hashlib.sha1(secret).hexdigest()[:8]
+
+
+class TokenBucket(object):
+    '''
+    A token bucket refilled at a constant rate; the server's view of the
+    budget (remaining, reset) overrides the local estimate when available.
+    The APIs use fixed windows, so after a sync the bucket holds what the
+    server reported (less what was spent since) until the window resets.
+    '''
+    def __init__(self, capacity, period):
+        '''
+        Start with a full bucket.
+        '''
+        self.capacity = capacity
+        self.period = period
+        self.tokens = float(capacity)
+        self.reset = None
+        self.stamp = time.time()
+
+    def refill(self, now):
+        '''
+        Add the tokens accumulated since the last refill.
+        '''
+        if self.reset is not None and now >= self.reset:
+            self.tokens, self.reset = float(self.capacity), None
+        elif self.reset is None:
+            rate = float(self.capacity) / self.period
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+
+    def wait(self, now, reserve=0):
+        '''
+        Seconds until a token (above the reserve) becomes available.
+        '''
+        self.refill(now)
+        needed = 1 + reserve - self.tokens
+        if needed <= 0:
+            return 0.0
+        if self.reset is not None:
+            return max(self.reset - now, 0.0)
+        return needed * self.period / float(self.capacity)
+
+    def take(self):
+        '''
+        Spend a token.
+        '''
+        self.tokens -= 1
+
+    def update(self, limit, remaining, reset):
+        '''
+        Synchronize the bucket with the server's headers.
+        '''
+        if limit is not None:
+            self.capacity = limit
+        if remaining is not None:
+            self.tokens = float(remaining)
+            self.reset = reset
+
+
+class RateLimiter(object):
+    '''
+    A thread-safe registry of token buckets keyed by (endpoint, account).
+    '''
+    def __init__(self, limits=None, reserve=RESERVE, sleep=time.sleep):
+        '''
+        Set the default limits; buckets are created lazily.
+        '''
+        self.limits = LIMITS if limits is None else limits
+        self.reserve = reserve
+        self.sleep = sleep
+        self.buckets = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, endpoint, account):
+        '''
+        Get (or create) the bucket for an endpoint and account.
+        '''
+        key = (endpoint, account)
+        if key not in self.buckets:
+            capacity, period = self.limits.get(endpoint, DEFAULT_LIMIT)
+            self.buckets[key] = TokenBucket(capacity, period)
+        return self.buckets[key]
+
+    def acquire(self, endpoint, account, priority=SEND, block=True):
+        '''
+        Take a token, waiting for one if the bucket is empty; low-priority
+        callers wait while the bucket is within its reserve.
+        Returns the seconds spent waiting, or None if non-blocking and empty.
+        '''
+        waited = 0.0
+        while True:
+            with self.lock:
+                bucket = self.bucket(endpoint, account)
+                reserve = self.reserve * bucket.capacity if priority else 0
+                delay = bucket.wait(time.time(), reserve)
+                if delay <= 0:
+                    bucket.take()
+                    return waited
+            if not block:
+                return None
+            LOGGER.warning('[rate-limit] %s (%s) exhausted; waiting %.1fs',
+                           endpoint, account, delay)
+            self.sleep(delay)
+            waited += delay
+
+    def update(self, endpoint, account, headers, throttled=False):
+        '''
+        Read the rate-limit headers of a response into the bucket.
+        '''
+        if headers is None:
+            return
+        names = HEADERS['twitter' if endpoint.startswith('twitter') else
+                        'github']
+        values = []
+        for name in names:
+            try:
+                values.append(int(headers.get(name)))
+            except (TypeError, ValueError):
+                values.append(None)
+        limit, remaining, reset = values
+
+        if throttled:
+            try:
+                # Secondary limits (GitHub) only say when to retry.
+                retry_after = int(headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                retry_after = None
+            if retry_after is not None:
+                remaining, reset = 0, int(time.time()) + retry_after
+            elif remaining is None:
+                remaining = 0
+                reset = reset or int(time.time()) + BACKOFF
+
+        with self.lock:
+            self.bucket(endpoint, account).update(limit, remaining, reset)
+
+    def failed(self, endpoint, status=None):
+        '''
+        Count a failed request (by HTTP status, if there was a response).
+        '''
+        key = (endpoint, str(status or 'none'))
+        with self.lock:
+            self.errors[key] = self.errors.get(key, 0) + 1
+
+    def failures(self):
+        '''
+        A snapshot of the failed requests, by (endpoint, status).
+        '''
+        with self.lock:
+            return dict(self.errors)
+
+    def budget(self):
+        '''
+        A snapshot of the remaining budget of every bucket.
+        '''
+        now = time.time()
+        snapshot = {}
+        with self.lock:
+            for (endpoint, account), bucket in self.buckets.items():
+                bucket.refill(now)
+                snapshot['{0}:{1}'.format(endpoint, account)] = {
+                    'capacity': bucket.capacity,
+                    'remaining': int(bucket.tokens),
+                    'reset': bucket.reset,
+                }
+        return snapshot
+
+
+# Shared by every module in the process.
+LIMITER = RateLimiter()
+
+# tweepy keeps the response of the last call on the API object, which the
+# threads of a process share (see config); a call and the read of its
+# headers hold the lock of the API, so that no other call comes between.
+CALLS = weakref.WeakKeyDictionary()
+CALLS_LOCK = threading.Lock()
+
+
+def lock_of(api):
+    '''
+    The call lock of a tweepy API (created on first use).
+    '''
+    with CALLS_LOCK:
+        lock = CALLS.get(api)
+        if lock is None:
+            lock = CALLS[api] = threading.Lock()
+        return lock
+
+
+def twitter(api, endpoint, method, *args, **kwargs):
+    '''
+    Call a tweepy API method within the rate-limit of its endpoint;
+    retry when Twitter throttles the request.
+    '''
+    priority = kwargs.pop('priority', SEND)
+    retries = kwargs.pop('retries', 2)
+    limiter = kwargs.pop('limiter', LIMITER)
+    endpoint = 'twitter:{0}'.format(endpoint)
+    account = account_of(getattr(api.auth, 'access_token', None))
+
+    for attempt in range(retries + 1):
+        limiter.acquire(endpoint, account, priority)
+        try:
+            with lock_of(api):
+                result = getattr(api, method)(*args, **kwargs)
+                response = getattr(api, 'last_response', None)
+            limiter.update(endpoint, account,
+                           getattr(response, 'headers', None))
+            return result
+        except Exception as error:
+            response = getattr(error, 'response', None)
+            code = getattr(response, 'status_code', None)
+            limiter.failed(endpoint, code)
+            if code not in THROTTLED or attempt == retries:
+                raise
+            LOGGER.warning('[rate-limit] %s throttled (%s); retrying',
+                           endpoint, code)
+            limiter.update(endpoint, account, response.headers,
+                           throttled=True)
@@ -0,0 +1,290 @@
+#! /usr/bin/env python2.7
+
+'''
+Find the gists and tweets of the bus whose TTL passed more than the given
+age ago (left behind by a failed push, or while expire was down) and delete
+them; push notes the expiry in the gist description and the tweet.
+Messages sent without a TTL (or before expiries were noted) are permanent
+and never deleted.
+The account's gists and timeline are listed in pages, from the cursor saved
+by the previous run, so that a run only reads what is new (or not expired
+yet); deletions run concurrently, within the rate-limits (behind the bus
+traffic).
+'''
+
+import os
+import re
+import json
+import time
+import calendar
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from argparse import ArgumentParser
+from logging import NullHandler, getLogger
+
+from log import setup
+from config import load_credentials
+from gist import listing, PAGE_SIZE
+from expire import remove
+from ratelimit import DELETE, twitter
+from metrics import REGISTRY
+from routing import PREFIX, PREFIX_V2
+
+# Logging is configured by log.setup() in main().
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Where the scan resumes from: the time of the last complete gist scan and
+# the latest tweet ID it read, held back to the oldest artifact which is
+# not due yet.
+CURSOR_PATH = 'vault/reconcile.json'
+
+# Pages per scan; GitHub lists at most 3000 gists, Twitter 3200 tweets
+# (200 a page).
+GIST_PAGES, TWEET_PAGES, TWEETS_PAGE = 30, 16, 200
+
+# Bus artifacts: gist descriptions (see gist.post), tweets (see push.send);
+# their expiry, if they have one.
+GIST = re.compile(r'^[0-9a-f]{5,40} \(twitter-message-bus\);')
+TWEET = re.compile(r'^(?:{0}|{1})-[0-9a-f]{{5,40}}:'.format(
+    re.escape(PREFIX), re.escape(PREFIX_V2)))
+GIST_EXPIRY = re.compile(r'; expires at (\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ)\.$')
+
+# Metrics.
+FOUND = dict((what, REGISTRY.counter('bus_reconcile_found_total',
+                                     'Expired artifacts found',
+                                     what=what))
+             for what in ('gist', 'tweet'))
+FAILED = REGISTRY.counter('bus_reconcile_failures_total',
+                          'Expired artifacts which could not be deleted')
+
+
+def timestamp(value):
+    '''
+    Seconds since the epoch, from an ISO 8601 string (GitHub) or a UTC
+    datetime (tweepy).
+    '''
+    if not isinstance(value, datetime):
+        value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+    return calendar.timegm(value.utctimetuple())
+
+
+def iso(seconds):
+    '''
+    An ISO 8601 (UTC) string, from seconds since the epoch.
+    '''
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def gist_expiry(description):
+    '''
+    The expiry noted in a gist description; None if there is none.
+    '''
+    match = GIST_EXPIRY.search(description)
+    return timestamp(match.group(1)) if match else None
+
+
+def tweet_expiry(text):
+    '''
+    The expiry field of a (v2) tweet; None if there is none.
+    '''
+    if not text.startswith(PREFIX_V2):
+        return None
+    fields = text.split(':')
+    return int(fields[5]) if len(fields) > 5 and fields[5].isdigit() \
+        else None
+
+
+def load_cursor(path=CURSOR_PATH):
+    '''
+    The cursor of the last run; empty (a full scan) if there is none.
+    '''
+    try:
+        with open(path, 'r') as cursor:
+            return json.loads(cursor.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def save_cursor(cursor, path=CURSOR_PATH):
+    '''
+    Write the cursor (atomically).
+    '''
+    with open(path + '.tmp', 'w') as temporary:
+        temporary.write(json.dumps(cursor))
+    os.rename(path + '.tmp', path)
+
+
+def scan_gists(token, horizon, since=None, debug=False):
+    '''
+    IDs of the bus gists which expired before the horizon (updated after
+    since); the creation time of the oldest one not due yet (None if there
+    is none); and whether the listing was read to the end.
+    '''
+    found, oldest = [], None
+    for page in range(1, GIST_PAGES + 1):
+        gists = listing(token, since=iso(since) if since else None,
+                        page=page, debug=debug)
+        if gists is None:
+            return found, oldest, False
+        for gist in gists:
+            description = gist.get('description') or ''
+            expiry = gist_expiry(description)
+            if not GIST.match(description) or expiry is None:
+                continue
+            if expiry < horizon:
+                found.append(gist['id'])
+            else:
+                created = timestamp(gist['created_at'])
+                oldest = created if oldest is None else min(oldest, created)
+        if len(gists) < PAGE_SIZE:
+            return found, oldest, True
+    LOGGER.warning('[reconcile] more than %d pages of gists; the cursor is '
+                   'kept', GIST_PAGES)
+    return found, oldest, False
+
+
+def scan_tweets(api, horizon, since_id=None):
+    '''
+    IDs of the bus tweets which expired before the horizon (posted after
+    since_id); the next since_id: the latest tweet ID read, or the one
+    before the oldest bus tweet not due yet; and whether the timeline was
+    read to the end.
+    '''
+    found, latest, held, max_id = [], since_id, None, None
+    for _ in range(TWEET_PAGES):
+        page = twitter(api, 'statuses/user_timeline', 'user_timeline',
+                       since_id=since_id, max_id=max_id, count=TWEETS_PAGE,
+                       priority=DELETE)
+        if not page:
+            if held is not None:
+                latest = min(latest, held - 1)
+            return found, latest, True
+        for status in page:
+            latest = max(latest or 0, status.id)
+            expiry = tweet_expiry(status.text) \
+                if TWEET.match(status.text) else None
+            if expiry is None:
+                continue
+            if expiry < horizon:
+                found.append(status.id_str)
+            else:
+                held = status.id if held is None else min(held, status.id)
+        max_id = page[-1].id - 1
+    LOGGER.warning('[reconcile] more than %d pages of tweets; the cursor is '
+                   'kept', TWEET_PAGES)
+    return found, since_id, False
+
+
+def purge(job):
+    '''
+    Delete a gist or a tweet; True if it is gone.
+    '''
+    what, which, auth, debug = job
+    try:
+        if remove(what, which, auth, debug):
+            return True
+    except Exception as _error:
+        LOGGER.error('[reconcile] unable to delete %s %s: %s', what, which,
+                     _error)
+    FAILED.inc()
+    return False
+
+
+def reconcile(tokens, max_age, cursor, **kwargs):
+    '''
+    Scan, delete (unless it is a dry-run); returns the next cursor.
+    '''
+    concurrency = kwargs['concurrency'] if 'concurrency' in kwargs else 4
+    dry_run = kwargs['dry_run'] if 'dry_run' in kwargs else False
+    debug = kwargs['debug'] if 'debug' in kwargs else False
+    start = time.time()
+    horizon = start - max_age
+
+    gists, oldest, listed = scan_gists(tokens[0], horizon,
+                                       cursor.get('gists'), debug)
+    tweets, latest, read = scan_tweets(tokens[1], horizon,
+                                       cursor.get('tweets'))
+    FOUND['gist'].inc(len(gists))
+    FOUND['tweet'].inc(len(tweets))
+    LOGGER.info('[reconcile] expired before %s: %d gists, %d tweets',
+                iso(horizon), len(gists), len(tweets))
+
+    if dry_run:
+        for gist_id in gists:
+            LOGGER.info('[reconcile] gist: %s', gist_id)
+        for tweet_id in tweets:
+            LOGGER.info('[reconcile] tweet: %s', tweet_id)
+        return cursor
+
+    jobs = ([('gist', _, tokens[0], debug) for _ in gists] +
+            [('tweet', _, tokens[1], debug) for _ in tweets])
+    pool = ThreadPool(max(concurrency, 1))
+    try:
+        results = pool.map(purge, jobs) if jobs else []
+    finally:
+        pool.close()
+        pool.join()
+    LOGGER.info('[reconcile] deleted %d of %d', sum(results), len(results))
+
+    # Only move past what was read to the end and deleted; the rest is
+    # scanned again next time.
+    cursor = dict(cursor)
+    if listed and all(results[:len(gists)]):
+        cursor['gists'] = start if oldest is None else oldest
+    if read and all(results[len(gists):]):
+        cursor['tweets'] = latest
+    return cursor
+
+
+def main():
+    '''
+    Validate arguments, load credentials, reconcile.
+    '''
+    message = 'Delete the expired gists, tweets of the bus.'
+    age_help = ('delete what expired (its TTL passed) more than this long '
+                'ago (in seconds)')
+    concurrency_help = 'concurrent deletions; defaults to 4'
+    cursor_help = ('file to resume the scan from; defaults to '
+                   '{0}').format(CURSOR_PATH)
+
+    parser = ArgumentParser(description=message)
+    parser.add_argument('-a', '--max-age', help=age_help, required=True,
+                        type=int, metavar=('SECONDS'))
+    parser.add_argument('-c', '--concurrency', help=concurrency_help,
+                        default=4, type=int, metavar=('N'))
+    parser.add_argument('-C', '--cursor', help=cursor_help,
+                        default=CURSOR_PATH, metavar=('FILE'))
+    parser.add_argument('-f', '--full', help='ignore the cursor; scan all',
+                        action='store_true', default=False)
+    parser.add_argument('-n', '--dry-run', help='only list what is found',
+                        action='store_true', default=False)
+    parser.add_argument('-d', '--debug', help='enable debugging',
+                        action='store_true', default=False)
+    parser.add_argument('-j', '--json-logs', help='log in JSON (per line)',
+                        action='store_true', default=False)
+
+    args = vars(parser.parse_args())
+
+    setup(debug=args['debug'], structured=args['json_logs'])
+
+    # Load the credentials.
+    tokens = load_credentials()
+
+    if None in tokens:
+        LOGGER.error('[load_credentials] unable to load credentials!')
+        return
+
+    cursor = {} if args['full'] else load_cursor(args['cursor'])
+    try:
+        cursor = reconcile(tokens, args['max_age'], cursor,
+                           concurrency=args['concurrency'],
+                           dry_run=args['dry_run'], debug=args['debug'])
+        save_cursor(cursor, args['cursor'])
+    except (IOError, OSError):
+        LOGGER.error('[reconcile] unable to write the cursor: %s',
+                     args['cursor'])
+
+
+if __name__ == '__main__':
+    main()
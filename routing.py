@@ -0,0 +1,177 @@
+#! /usr/bin/env python2.7
+
+'''
+Route announcements to per-recipient queues ('in:<recipient>'), so that a
+pull daemon only reads the messages meant for it.
+
+A rule is written as SENDER[:TAG]=RECIPIENT; SENDER is a Twitter screen
+name (or * for anyone) and TAG the (optional) recipient tag of the tweet.
+The most specific rule wins; a tweet without a matching rule goes to the
+shared 'in' queue (a tagged one is logged and counted, as no pull daemon
+may read the queue of its tag). Recipients are Keybase usernames, so queue
+names are lower-case, without a leading '@'.
+
+Every queue has priority lanes: 'high' and 'low' traffic goes to QUEUE#high
+and QUEUE#low, 'normal' traffic to the queue itself. Consumers poll the
+lanes in a weighted order (see Schedule), so a burst of bulk messages
+doesn't hold up urgent ones, and low lanes aren't starved.
+'''
+
+import re
+import threading
+from logging import NullHandler, getLogger
+
+from metrics import REGISTRY
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Announcement prefixes: PREFIX-hash:gist-id (the original format, which
+# older listeners split in two) and
+# PREFIX_V2-hash:gist-id:sent[:tag[:lane[:expires]]] (which they don't
+# match, so they skip it instead of failing on it).
+PREFIX, PREFIX_V2 = 'twitter-message-bus', 'message-bus-v2'
+
+# The shared queue (no recipient); per-recipient queues are prefixed.
+SHARED = 'in'
+
+# Recipient tags (Keybase usernames).
+TAG = re.compile(r'^[A-Za-z0-9_]{1,16}$')
+
+# Priority lanes, most urgent first; the relative share of the polls each
+# lane leads when all of them have work.
+LANES = ('high', 'normal', 'low')
+NORMAL = 'normal'
+WEIGHTS = {'high': 6, 'normal': 3, 'low': 1}
+
+# Expiry lanes, by TTL (in seconds): deletions due soon go ahead of the
+# ones that will wait for days.
+SOON, LATER = 300, 86400
+
+# Metrics.
+UNMATCHED = REGISTRY.counter('bus_routing_unmatched_total',
+                             'Tagged announcements without a matching '
+                             'rule (sent to the shared queue)')
+
+
+def queue_of(recipient=None):
+    '''
+    The name of the queue for a recipient (pull -R Alice reads in:alice).
+    '''
+    recipient = (recipient or '').strip().lstrip('@').lower()
+    return ':'.join([SHARED, recipient]) if recipient else SHARED
+
+
+def queues_of(recipients):
+    '''
+    The queues a pull daemon reads, for the given recipients.
+    '''
+    return [queue_of(_) for _ in recipients] if recipients else [SHARED]
+
+
+def tag_of(field):
+    '''
+    The recipient tag of a tweet field; None if it isn't a valid one.
+    '''
+    field = (field or '').strip()
+    return field.lower() if TAG.match(field) else None
+
+
+def lane_of(field):
+    '''
+    The priority lane named by a tweet (or job) field; normal by default.
+    '''
+    field = (field or '').strip().lower()
+    return field if field in LANES else NORMAL
+
+
+def laned(queue, lane=NORMAL):
+    '''
+    The name of a lane of a queue.
+    '''
+    return queue if lane == NORMAL else '#'.join([queue, lane])
+
+
+def expiry_lane(ttl):
+    '''
+    The lane of the 'out' queue for a TTL.
+    '''
+    if ttl <= SOON:
+        return 'high'
+    return 'low' if ttl >= LATER else NORMAL
+
+
+class Schedule(object):
+    '''
+    Weighted (smooth) round-robin over the lanes of some queues; every poll
+    lists all the lanes, the one whose turn it is first and the others by
+    priority, so a consumer never waits while any lane has work.
+    '''
+    def __init__(self, queues, weights=None):
+        self.weights = weights or WEIGHTS
+        self.lanes = dict((lane, [laned(_, lane) for _ in queues])
+                          for lane in LANES)
+        self.credit = dict((lane, 0) for lane in LANES)
+        self.lock = threading.Lock()
+
+    @property
+    def queues(self):
+        '''
+        All the lanes, by priority.
+        '''
+        return [_ for lane in LANES for _ in self.lanes[lane]]
+
+    def next(self):
+        '''
+        The lanes to poll, in order, for the next job.
+        '''
+        total = sum(self.weights[_] for _ in LANES)
+        with self.lock:
+            for lane in LANES:
+                self.credit[lane] += self.weights[lane]
+            turn = max(LANES, key=lambda _: self.credit[_])
+            self.credit[turn] -= total
+        return self.lanes[turn] + [_ for lane in LANES if lane != turn
+                                   for _ in self.lanes[lane]]
+
+
+class Router(object):
+    '''
+    Map (sender, tag) pairs to queues.
+    '''
+    def __init__(self, rules=None):
+        self.rules = {}
+        for rule in rules or []:
+            self.add(rule)
+
+    def add(self, rule):
+        '''
+        Parse and add a rule (SENDER[:TAG]=RECIPIENT).
+        '''
+        try:
+            match, recipient = rule.split('=', 1)
+            sender, _, tag = match.partition(':')
+        except ValueError:
+            raise ValueError('invalid rule: {0}'.format(rule))
+        sender = sender.strip().lstrip('@').lower() or '*'
+        recipient = tag_of(recipient)
+        if recipient is None or (tag and tag_of(tag) is None):
+            raise ValueError('invalid recipient in rule: {0}'.format(rule))
+        self.rules[(sender, tag_of(tag))] = queue_of(recipient)
+
+    def route(self, sender, tag=None):
+        '''
+        The queue for an announcement from sender, with an optional tag.
+        '''
+        sender = sender.lower()
+        candidates = [(sender, None), ('*', None)]
+        if tag is not None:
+            candidates[:0] = [(sender, tag), ('*', tag)]
+        for key in candidates:
+            if key in self.rules:
+                return self.rules[key]
+        if tag is not None:
+            UNMATCHED.inc()
+            LOGGER.warning('[route] no rule for %s:%s; using the shared '
+                           'queue', sender, tag)
+        return SHARED
@@ -5,129 +5,367 @@ Manage the disque (redis queue) instance; listen to tweets using Twitter's
 Streaming API, dump them into the 'in' queue.
 '''
 
+import os
 import re
 import sys
 import json
+import time
+import random
+import threading
+from collections import deque
 from argparse import ArgumentParser
-from logging import (NullHandler, getLogger, StreamHandler, Formatter, DEBUG,
-                     INFO)
+from logging import NullHandler, getLogger, DEBUG
 
 import tweepy
-from pydisque.client import Client
 
-# Formatting for logger output.
+from log import setup, Sample
+from config import load_credentials
+from metrics import REGISTRY, serve
+from ratelimit import twitter
+from routing import Router, tag_of, lane_of, laned, PREFIX, PREFIX_V2
+from tracing import TRACER, millis, seconds
+
+# Logging is configured by log.setup() in main().
 getLogger(__name__).addHandler(NullHandler())
-LOGGER = getLogger()
-HANDLER = StreamHandler()
-FORMATTER = Formatter(
-    ('%(asctime)s; %(name)s, %(levelname)s; PID: %(process)s; '
-     '%(module)s: %(funcName)s; traceback: %(exc_info)s; %(message)s')
-)
-HANDLER.setFormatter(FORMATTER)
+LOGGER = getLogger(__name__)
+
+# Metrics.
+STATUS_LATENCY = REGISTRY.histogram('bus_stream_status_seconds',
+                                    'Time spent handling a status')
+STATUSES = dict((result, REGISTRY.counter('bus_stream_statuses_total',
+                                          'Statuses received, by outcome',
+                                          result=result))
+                for result in ('queued', 'handed-off', 'duplicate',
+                               'discarded', 'lost'))
+BACKFILLED = REGISTRY.counter('bus_stream_backfilled_total',
+                              'Statuses fetched from the timelines after a '
+                              '(re)connect')
+RECONNECTS = REGISTRY.counter('bus_stream_reconnects_total',
+                              'Times the stream was (re)started')
+
+# Discarded tweets are high-volume; only log a sample.
+DISCARDS = Sample(100)
+
+# The ID of the latest status seen from each followed account is kept here;
+# after a restart or a reconnect, the timelines are read from that point on.
+WATERMARK_PATH = 'vault/watermark.json'
+
+# Reconnect back-off (in seconds): doubles after every failed attempt, up to
+# the cap; reset when a connection stayed up for a while.
+BACKOFF = (1, 320)
+BACKOFF_RESET = 60
+
+# Timeline pages for the back-fill; Twitter returns at most 200 statuses a
+# page and 3200 in all.
+PAGE_SIZE, MAX_PAGES = 200, 16
+
+# Gist IDs remembered to drop duplicates (stream vs. back-fill).
+RECENT = 10000
 
 # Take care of nasty non standard ASCII errors.
 # reload(sys)
 # sys.setdefaultencoding("utf-8")
 
 
-'''
-Credentials are stored here, change this path and the load_credentials()
-method to override defaults.
-
-Notes:
-    [*] Get a personal access token on Github: https://git.io/vmNUX;
-        make sure you include 'gist' in the scope.
-    [*] Get a personal access token for your application on Twitter:
-        https://dev.twitter.com/oauth/overview/application-owner-access-tokens;
-        make sure you create an application before you create the access
-        tokens.
-    [*] API error codes: https://dev.twitter.com/overview/api/response-codes
-
-By defualt, keys are stored this way (in JSON):
-    {
-        "github": "github-personal-access-token",
-        "twitter": {
-            "consumer-key": "twitter-app-consumer-key",
-            "consumer-secret": "twitter-app-consumer-secret",
-            "access-token": "twitter-app-access-token",
-            "access-token-secret": "twitter-app-access-token-secret"
-        }
-    }
-'''
-VAULT_PATH = 'vault/keys.json'
-
-
-def load_credentials(path=VAULT_PATH):
+class Watermark(object):
     '''
-    Load credentials from vault.
+    The latest status ID queued per (followed) account; saved to a file,
+    at most every interval seconds (see flush) unless asked to.
     '''
-    api = None
-    with open(path, 'r') as vault_file:
+    def __init__(self, path=WATERMARK_PATH, interval=5):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.saved = 0
+        self.dirty = False
         try:
-            vault = json.loads(vault_file.read())
-            auth = tweepy.OAuthHandler(vault['twitter']['consumer-key'],
-                                       vault['twitter']['consumer-secret'])
-            auth.set_access_token(vault['twitter']['access-token'],
-                                  vault['twitter']['access-token-secret'])
-            api = tweepy.API(auth)
+            with open(path, 'r') as marks:
+                self.marks = json.loads(marks.read())
+        except (IOError, ValueError):
+            self.marks = {}
+
+    def get(self, account):
+        '''
+        The high-water mark of an account; None if it was never seen.
+        '''
+        return self.marks.get(account.lower())
+
+    def snapshot(self, accounts):
+        '''
+        The marks of the accounts, as they are now.
+        '''
+        with self.lock:
+            return dict((_, self.marks.get(_.lower())) for _ in accounts)
+
+    def advance(self, account, status_id):
+        '''
+        Move the mark of the account forward (never back).
+        '''
+        with self.lock:
+            if status_id > self.marks.get(account.lower(), 0):
+                self.marks[account.lower()] = status_id
+                self.dirty = True
+        self.flush()
 
-        except IOError:
-            print 'Unable to read vault-file: {0}.'.format(path)
-        except (KeyError, ValueError):
-            print 'Unable to parse the vault-file.'
+    def flush(self):
+        '''
+        Save the marks if the last save is older than the interval.
+        '''
+        if time.time() - self.saved >= self.interval:
+            self.save()
+
+    def save(self):
+        '''
+        Write the marks (atomically) if they changed.
+        '''
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                with open(self.path + '.tmp', 'w') as marks:
+                    marks.write(json.dumps(self.marks))
+                os.rename(self.path + '.tmp', self.path)
+                self.dirty, self.saved = False, time.time()
+            except (IOError, OSError):
+                LOGGER.error('[watermark] unable to write %s', self.path)
+
+
+class Recent(object):
+    '''
+    A bounded set; the oldest keys are forgotten first.
+    '''
+    def __init__(self, size=RECENT):
+        self.size = size
+        self.order = deque()
+        self.keys = set()
+        self.lock = threading.Lock()
 
-    return api
+    def add(self, key):
+        '''
+        Remember the key; False if it is already known.
+        '''
+        with self.lock:
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+            self.order.append(key)
+            if len(self.order) > self.size:
+                self.keys.discard(self.order.popleft())
+            return True
+
+    def forget(self, key):
+        '''
+        Drop the key (if it is known).
+        '''
+        with self.lock:
+            self.keys.discard(key)
 
 
 class StreamDaemon(tweepy.StreamListener):
     '''
     Listen to Twitter.
     '''
-    def __init__(self, queue):
+    def __init__(self, queue, handoff=None, **kwargs):
         '''
-        Adds queue to the derived class.
+        Adds queue to the derived class; handoff (optional) is offered
+        every job first, with its queue, and returns True if it took it
+        (see node). A router picks the queue of every announcement.
+        With credentials, channels and a watermark, statuses missed while
+        disconnected are read back from the timelines on (re)connect.
         '''
         super(StreamDaemon, self).__init__()
         self.queue = queue
-        self.prefix = 'twitter-message-bus'
+        self.handoff = handoff
+        self.prefixes = (PREFIX_V2, PREFIX)
+        self.credentials = kwargs.get('credentials')
+        self.channels = [_.lower() for _ in kwargs.get('channels') or []]
+        self.watermark = kwargs.get('watermark')
+        self.router = kwargs.get('router') or Router()
+        self.seen = Recent()
+        self.connected = None
+        self.lock = threading.Lock()
+        self.backfilling, self.pending = False, None
+
+    def on_connect(self):
+        '''
+        Catch up (in the background) with the statuses missed while the
+        stream was down; the marks are taken now, before the stream moves
+        them past the gap.
+        '''
+        LOGGER.info('[connected] user-stream is up')
+        self.connected = time.time()
+        if self.credentials is not None and self.watermark is not None:
+            marks = self.watermark.snapshot(self.channels)
+            thread = threading.Thread(target=self.backfill, args=(marks,),
+                                      name='backfill')
+            thread.daemon = True
+            thread.start()
+
+    def keep_alive(self):
+        '''
+        Save the marks which changed since the last save (the stream sends
+        a keep-alive every 30 seconds or so).
+        '''
+        if self.watermark is not None:
+            self.watermark.flush()
 
     def on_status(self, status):
         '''
-        Do this, when you receive a new status.
+        Do this, when you receive a new status; tweepy drops the stream on
+        an exception, so one bad status is logged and skipped instead.
+        '''
+        with STATUS_LATENCY.time():
+            try:
+                self.handle(status)
+            except Exception as _error:
+                LOGGER.error('[tweet-error] id: %s; %s',
+                             getattr(status, 'id', None), _error)
+
+    def mark(self, author, status_id):
+        '''
+        Advance the high-water mark of a followed account (once a status
+        of it is queued).
+        '''
+        if self.watermark is not None and author.lower() in self.channels:
+            self.watermark.advance(author, status_id)
+
+    def handle(self, status):
+        '''
+        Filter the status, queue the gist ID.
         '''
         __id = status.id
         __from = status.author.screen_name
         __text = status.text.strip()
         __content = ''.join([i if ord(i) < 128 else ' ' for i in __text])
-        __timestamp = status.timestamp_ms
-
-        log = ('[tweet] id: {0}; timestamp: {1}; '
-               'from: {2}; content: {3}').format(__id, __timestamp,
-                                                 __from, __content)
+        # Statuses from the timelines (back-fill) carry no timestamp_ms.
+        __timestamp = getattr(status, 'timestamp_ms', None)
 
         # Filter out SHA1, discard the rest.
         pattern = re.compile(r'\b[0-9a-f]{5,40}\b')
 
-        if re.search(re.escape(self.prefix), __content):
-            __content = re.sub(re.escape(self.prefix), '', __content)
-            _random, _gist_id = __content.split(':')
-            if pattern.search(_random):
-                LOGGER.info('[tweet] %s', log)
-                LOGGER.debug('[incoming-tweet] %s', status)
+        __fields = None
+        __prefix = next((_ for _ in self.prefixes if _ in __content), None)
+        if __prefix is not None:
+            __content = __content.replace(__prefix, '')
+            # prefix-hash:gist-id[:sent-ms[:recipient[:lane[:expires]]]];
+            # the expiry is only read by reconcile. Anything else (a tweet
+            # which only mentions the prefix) is discarded.
+            __fields = __content.split(':')
+            if len(__fields) < 2 or not pattern.search(__fields[0]) or \
+                    not __fields[1].strip():
+                __fields = None
+
+        if __fields is not None:
+            _fields = __fields + [''] * (5 - len(__fields))
+            _random, _gist_id, _sent = _fields[0], _fields[1], _fields[2]
+            _tag, _lane = tag_of(_fields[3]), lane_of(_fields[4])
+            if not self.seen.add(_gist_id):
+                STATUSES['duplicate'].inc()
+                LOGGER.info('[tweet-duplicate] id: %s; gist: %s', __id,
+                            _gist_id)
+                return
+
+            LOGGER.info('[tweet] id: %s; timestamp: %s; from: %s; '
+                        'content: %s', __id, __timestamp, __from,
+                        __content)
+            LOGGER.debug('[incoming-tweet] %s', status)
+
+            # The hash is the trace ID; Twitter's timestamp marks the
+            # start of the stream hop.
+            _trace, _now = _random.lstrip('-'), time.time()
+            TRACER.record(_trace, 'stream-receive',
+                          seconds(__timestamp), _now)
+
+            # Hand the message over (in-process) or push it to the
+            # queue of its recipient.
+            try:
+                __queue = laned(self.router.route(__from, _tag), _lane)
+                with TRACER.span(_trace, 'enqueue'):
+                    __job = '~'.join([_gist_id, _trace, _sent, millis(),
+                                      _lane])
+                    __job_id = None
+                    if self.handoff is None or \
+                            not self.handoff(__queue, __job):
+                        __job_id = self.queue.add_job(__queue, __job)
+                if __job_id is None:
+                    LOGGER.info('[handed-off] %s', __job)
+                    STATUSES['handed-off'].inc()
+                else:
+                    LOGGER.info('[queued] %s; job-id: %s', __queue,
+                                __job_id)
+                    STATUSES['queued'].inc()
+                REGISTRY.counter('bus_stream_routed_total',
+                                 'Announcements, by destination queue',
+                                 queue=__queue).inc()
+                self.mark(__from, __id)
+
+            except Exception:
+                self.seen.forget(_gist_id)
+                STATUSES['lost'].inc()
+                LOGGER.critical(('[queue-error]: Unable to add job; '
+                                 'message lost.'))
+        else:
+            STATUSES['discarded'].inc()
+            if DISCARDS():
+                LOGGER.info('[tweet-discard] %s (1 in %d logged)',
+                            __content, DISCARDS.every)
+
+        return
 
-                # Push the message to the 'in' queue.
+    def backfill(self, marks):
+        '''
+        Read the followed timelines back to the marks (taken on connect);
+        runs once more if the stream reconnected in the meantime.
+        '''
+        with self.lock:
+            if self.backfilling:
+                # The oldest marks cover the later gaps as well.
+                if self.pending is None:
+                    self.pending = marks
+                return
+            self.backfilling = True
+
+        while True:
+            for channel in self.channels:
                 try:
-                    __job_id = self.queue.add_job('in', _gist_id)
-                    LOGGER.info('[queued] job-id: %s', __job_id)
+                    self.catch_up(channel, marks.get(channel))
+                except Exception as _error:
+                    LOGGER.error('[backfill] %s: %s', channel, _error)
+            self.watermark.save()
+            with self.lock:
+                if self.pending is None:
+                    self.backfilling = False
+                    return
+                marks, self.pending = self.pending, None
+
+    def catch_up(self, channel, since):
+        '''
+        Page through a timeline (newest first) down to the mark, handle the
+        statuses oldest first.
+        '''
+        if since is None:
+            LOGGER.info('[backfill] %s: no high-water mark yet', channel)
+            return
 
-                except Exception:
-                    LOGGER.critical(('[queue-error]: Unable to add job; '
-                                     'message lost.'))
+        statuses, max_id = [], None
+        for _ in range(MAX_PAGES):
+            page = twitter(self.credentials[1], 'statuses/user_timeline',
+                           'user_timeline', screen_name=channel,
+                           since_id=since, max_id=max_id, count=PAGE_SIZE)
+            if not page:
+                break
+            statuses.extend(page)
+            max_id = page[-1].id - 1
         else:
-            LOGGER.info('[tweet-discard] %s', __content)
-
-        return
+            LOGGER.warning('[backfill] %s: gap larger than the timeline; '
+                           'older statuses are lost', channel)
 
+        LOGGER.info('[backfill] %s: %d statuses since %s', channel,
+                    len(statuses), since)
+        BACKFILLED.inc(len(statuses))
+        for status in reversed(statuses):
+            # A bad status doesn't end the back-fill of the channel.
+            self.on_status(status)
 
     def on_error(self, status):
         '''
@@ -159,6 +397,32 @@ class StreamDaemon(tweepy.StreamListener):
         return
 
 
+def follow(credentials, listener, channels, backoff=BACKOFF):
+    '''
+    Keep the user-stream up; reconnect with an exponential (jittered)
+    back-off whenever it drops.
+    '''
+    delay = backoff[0]
+    while True:
+        RECONNECTS.inc()
+        started = time.time()
+        streamer = tweepy.Stream(auth=credentials[1].auth, listener=listener)
+        try:
+            streamer.userstream(track=channels)
+            LOGGER.warning('[stream] disconnected')
+        except Exception as _error:
+            LOGGER.error('[stream] connection failed: %s', _error)
+        if listener.watermark is not None:
+            listener.watermark.save()
+
+        connected = listener.connected or 0
+        if connected >= started and time.time() - connected > BACKOFF_RESET:
+            delay = backoff[0]
+        LOGGER.info('[stream] reconnecting in %d seconds', delay)
+        time.sleep(random.uniform(delay / 2.0, delay))
+        delay = min(delay * 2, backoff[1])
+
+
 def main():
     '''
     This is the main method, validate args, load credentials, start the daemon.
@@ -166,6 +430,15 @@ def main():
     message = 'Listen to tweets; dump them to the queue.'
     socket_help = ('a list containing the host, port numbers to listen to; '
                    'defaults to localhost:7711 (for disque)')
+    metrics_help = ('expose metrics on this local HTTP port; '
+                    'disabled by default')
+    trace_help = ('append latency spans (JSON lines) to this file; '
+                  'disabled by default')
+    watermark_help = ('file to keep the latest status IDs in (to catch up '
+                      'after a disconnect); defaults to {0}').format(
+                          WATERMARK_PATH)
+    routes_help = ('route announcements to recipient queues; '
+                   'SENDER[:TAG]=RECIPIENT, * matches any sender')
 
     parser = ArgumentParser(description=message)
     parser.add_argument('-s', '--sockets', help=socket_help,
@@ -176,34 +449,54 @@ def main():
                         required=True)
     parser.add_argument('-d', '--debug', help='enable debugging',
                         action='store_true', default=False)
+    parser.add_argument('-j', '--json-logs', help='log in JSON (per line)',
+                        action='store_true', default=False)
+    parser.add_argument('-m', '--metrics-port', help=metrics_help,
+                        default=None, type=int, metavar=('PORT'))
+    parser.add_argument('-T', '--trace', help=trace_help, default=None,
+                        metavar=('FILE'))
+    parser.add_argument('-W', '--watermark', help=watermark_help,
+                        default=WATERMARK_PATH, metavar=('FILE'))
+    parser.add_argument('-o', '--routes', help=routes_help, default=[],
+                        nargs='+', metavar=('RULE'))
 
     args = vars(parser.parse_args())
 
-    if args['debug']:
-        LOGGER.setLevel(DEBUG)
-        LOGGER.addHandler(HANDLER)
-    else:
-        LOGGER.setLevel(INFO)
-        LOGGER.addHandler(HANDLER)
+    try:
+        router = Router(args['routes'])
+    except ValueError as _error:
+        parser.error(str(_error))
+
+    setup(debug=args['debug'], structured=args['json_logs'])
+
+    if args['metrics_port']:
+        serve(args['metrics_port'])
+
+    if args['trace']:
+        TRACER.open(args['trace'], service='stream')
 
     try:
         # Connect to the redis-queue.
-        queue = Client(args['sockets'])
+        from cluster import Cluster
+        queue = Cluster(args['sockets'])
         queue.connect()
         LOGGER.info('[start-daemon]')
-        queue_info = json.dumps(queue.info(), indent=4)
-        LOGGER.debug('[queue-init]\n%s', queue_info)
+        if LOGGER.isEnabledFor(DEBUG):
+            LOGGER.debug('[queue-init]\n%s',
+                         json.dumps(queue.info(), indent=4))
 
         # Load credentials, initialize authentication module, listen to tweets.
-        api = load_credentials()
-        if not api:
+        credentials = load_credentials()
+        if not credentials.twitter:
             LOGGER.error('[load_credentials] unable to load credentials!')
             return
 
-        listener = StreamDaemon(queue)
-        streamer = tweepy.Stream(auth=api.auth, listener=listener)
         args['channels'] = [re.sub('@', '', _) for _ in args['channels']]
-        streamer.userstream(track=args['channels'])
+        listener = StreamDaemon(queue, credentials=credentials,
+                                channels=args['channels'],
+                                watermark=Watermark(args['watermark']),
+                                router=router)
+        follow(credentials, listener, args['channels'])
 
     except Exception:
         LOGGER.error('[error] unknown error')
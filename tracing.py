@@ -0,0 +1,155 @@
+#! /usr/bin/env python2.7
+
+'''
+End-to-end latency tracing; every message carries a trace ID (the hash in
+the tweet, gist description) and its send timestamp, each hop records the
+time spent per stage as a JSON span (one per line) in a local file.
+
+Run this module on the span files to get a p50/p99 report per stage.
+'''
+
+import sys
+import math
+import json
+import time
+import threading
+from argparse import ArgumentParser
+from logging import NullHandler, getLogger
+
+getLogger(__name__).addHandler(NullHandler())
+LOGGER = getLogger(__name__)
+
+# Stages, in the order a message goes through them.
+STAGES = ('encrypt', 'sign', 'gist-post', 'tweet', 'send', 'stream-receive',
+          'enqueue', 'queue-wait', 'gist-fetch', 'verify', 'decrypt',
+          'end-to-end')
+
+
+def millis(timestamp=None):
+    '''
+    A (compact) timestamp in milliseconds, for tweets and queue jobs.
+    '''
+    return str(int((time.time() if timestamp is None else timestamp) * 1000))
+
+
+def seconds(value):
+    '''
+    Convert a millisecond timestamp back to seconds; None if invalid.
+    '''
+    try:
+        return int(value) / 1000.0
+    except (TypeError, ValueError):
+        return None
+
+
+class Span(object):
+    '''
+    Context manager; records the time spent in the block.
+    '''
+    __slots__ = ('tracer', 'trace', 'stage', 'start')
+
+    def __init__(self, tracer, trace, stage):
+        self.tracer, self.trace, self.stage = tracer, trace, stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *_):
+        self.tracer.record(self.trace, self.stage, self.start, time.time())
+
+
+class Tracer(object):
+    '''
+    Write spans to a file; does nothing until a file is opened.
+    '''
+    def __init__(self, service=None):
+        self.service = service
+        self.sink = None
+        self.lock = threading.Lock()
+
+    def open(self, path, service=None):
+        '''
+        Start appending spans to the file.
+        '''
+        self.sink = open(path, 'a')
+        if service is not None:
+            self.service = service
+        LOGGER.info('[trace] writing spans to %s', path)
+
+    def record(self, trace, stage, start, end):
+        '''
+        Record a span that ran from start to end (in seconds).
+        '''
+        if self.sink is None or trace is None or start is None:
+            return
+        span = json.dumps({
+            'trace': trace,
+            'stage': stage,
+            'service': self.service,
+            'start': round(start, 6),
+            'duration': round(end - start, 6),
+        }, sort_keys=True)
+        with self.lock:
+            self.sink.write(span + '\n')
+            self.sink.flush()
+
+    def span(self, trace, stage):
+        '''
+        Time a block of code as a span.
+        '''
+        return Span(self, trace, stage)
+
+
+# Shared by every module in the process.
+TRACER = Tracer()
+
+
+def percentile(values, fraction):
+    '''
+    Nearest-rank percentile of a sorted list.
+    '''
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+
+def report(paths, out=sys.stdout):
+    '''
+    Print the count, p50, p99 and max duration of every stage.
+    '''
+    durations = {}
+    for path in paths:
+        with open(path, 'r') as spans:
+            for line in spans:
+                try:
+                    span = json.loads(line)
+                    durations.setdefault(span['stage'], []).append(
+                        float(span['duration']))
+                except (KeyError, ValueError):
+                    LOGGER.warning('[trace] skipping line: %s', line.strip())
+
+    order = [_ for _ in STAGES if _ in durations]
+    order += sorted(set(durations) - set(STAGES))
+    out.write('{0:<16}{1:>8}{2:>12}{3:>12}{4:>12}\n'.format(
+        'stage', 'count', 'p50 (ms)', 'p99 (ms)', 'max (ms)'))
+    for stage in order:
+        values = sorted(durations[stage])
+        out.write('{0:<16}{1:>8}{2:>12.1f}{3:>12.1f}{4:>12.1f}\n'.format(
+            stage, len(values), percentile(values, 0.5) * 1000,
+            percentile(values, 0.99) * 1000, values[-1] * 1000))
+
+
+def main():
+    '''
+    Report latency per stage from span files.
+    '''
+    message = 'Report latency (p50, p99) per stage from trace spans.'
+    parser = ArgumentParser(description=message)
+    parser.add_argument('files', help='span files (JSON lines)',
+                        metavar=('FILE'), nargs='+')
+    args = vars(parser.parse_args())
+    report(args['files'])
+
+
+if __name__ == '__main__':
+    main()